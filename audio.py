@@ -0,0 +1,385 @@
+# audio.py
+
+import itertools
+import mmap
+import os
+import threading
+import time
+from collections import deque
+
+import discord
+from discord.oggparse import OggError, OggStream
+from discord.player import OPUS_SILENCE
+
+import config
+import metrics
+
+FRAME_DURATION = 0.02
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+SILENCE = b"\x00" * FRAME_SIZE
+# A stream that stops this close to its known duration simply finished.
+END_TOLERANCE = 2.0
+
+# NumPy is imported by the first MixingSource, which keeps it off the startup path.
+np = None
+
+
+def _load_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+
+
+def observe_frame(source):
+    # Feeds time-to-first-audio and frame jitter; only called while metrics are enabled.
+    now = time.perf_counter()
+    if source.requested_at is not None:
+        metrics.FIRST_AUDIO_SECONDS.observe(now - source.requested_at)
+        source.requested_at = None
+    if source.last_read is not None:
+        metrics.FRAME_JITTER_SECONDS.observe(abs(now - source.last_read - FRAME_DURATION))
+    source.last_read = now
+
+
+def stream_dropped(source):
+    # Called from the audio thread when a source runs dry. If the stream was cut off
+    # (an expired or dropped URL) it asks for a recovery through `on_drop` and returns
+    # True while one is pending, so the caller plays silence instead of ending the
+    # track. A replacement that fails before its first frame is not retried. Nothing
+    # is buffered ahead of the cut, so that silence lasts as long as the recovery.
+    if source.recovering is not None:
+        return time.perf_counter() - source.recovering < config.RECOVERY_TIMEOUT
+    if source.on_drop is None or source.recoveries >= config.RECOVERY_ATTEMPTS:
+        return False
+    # Without a known duration (live streams) a drop can't be told from the end.
+    if not source.duration:
+        return False
+    if source.recoveries and not source.frames:
+        return False
+    if source.duration - source.position <= END_TOLERANCE:
+        return False
+    source.recovering = time.perf_counter()
+    source.recoveries += 1
+    source.on_drop(source)
+    return True
+
+
+def passthrough_compatible(track):
+    # YouTube's webm audio is usually Opus at 48 kHz, which Discord can take as-is.
+    return track.acodec == "opus" and track.asr in (None, 48000)
+
+
+class OggOpusReader:
+    # Plays a cached .opus file by handing its packets over as they are: no ffmpeg
+    # process, and the file is memory-mapped so pages come from the page cache.
+    def __init__(self, path, offset=0.0):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._packets = OggStream(self._map).iter_packets()
+        # OpusHead and OpusTags come first, then (as with ffmpeg's copy) 20 ms per packet.
+        for _ in itertools.islice(self._packets, 2 + int(offset / FRAME_DURATION)):
+            pass
+
+    def read(self):
+        try:
+            return next(self._packets, b"")
+        except (OggError, ValueError):
+            # Corrupt page, or closed by a volume change while being read.
+            return b""
+
+    def cleanup(self):
+        self._map.close()
+
+
+class OpusSource(discord.AudioSource):
+    # Hands Opus packets straight to discord.py so the bot never decodes to PCM or
+    # re-encodes in Python. The stream is copied when the track is already Opus at
+    # 48 kHz and volume is 100%; otherwise ffmpeg applies the volume filter and encodes.
+    # Volume changes restart ffmpeg in place at the current playback offset.
+    def __init__(self, track, *, volume=1.0, offset=0.0, before_options="", options=""):
+        self.track = track
+        self.title = track.title
+        self.url = track.webpage_url
+        self.duration = track.duration
+        self.thumbnail = track.thumbnail
+        self.before_options = before_options
+        self.options = options
+        self._volume = volume
+        self._lock = threading.Lock()
+        self.offset = offset
+        self.frames = 0
+        self.requested_at = None
+        self.last_read = None
+        self.on_drop = None
+        self.recovering = None
+        self.recoveries = 0
+        self.original = self._spawn()
+
+    @property
+    def position(self):
+        return self.offset + self.frames * FRAME_DURATION
+
+    @property
+    def copied(self):
+        return passthrough_compatible(self.track) and self._volume == 1.0
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        with self._lock:
+            self._volume = max(value, 0.0)
+            self.offset, self.frames = self.position, 0
+            previous, self.original = self.original, self._spawn()
+        previous.cleanup()
+
+    def _spawn(self):
+        if self.copied and os.path.isfile(self.track.stream_url):
+            return OggOpusReader(self.track.stream_url, self.offset)
+        before_options = self.before_options
+        if self.offset:
+            before_options = f"{before_options} -ss {self.offset:.2f}"
+        options = self.options
+        if not self.copied:
+            options = f'{options} -filter:a "volume={self._volume:.2f}"'
+        # discord.py copies the stream when told the input is already Opus, and encodes otherwise.
+        return discord.FFmpegOpusAudio(
+            self.track.stream_url,
+            codec="opus" if self.copied else None,
+            before_options=before_options.strip(),
+            options=options.strip(),
+        )
+
+    def read(self):
+        original = self.original
+        data = original.read()
+        if not data and original is not self.original:
+            # The process we were reading from was replaced by a volume change.
+            return self.read()
+        if data:
+            self.frames += 1
+            if metrics.enabled:
+                observe_frame(self)
+        elif stream_dropped(self):
+            return OPUS_SILENCE
+        return data
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.original.cleanup()
+
+
+class MixingSource(discord.AudioSource):
+    # PCM source that applies gain with NumPy over whole 20 ms frames. Volume changes
+    # ramp over VOLUME_RAMP seconds instead of clicking. A few seconds before the
+    # current track ends it asks for the next one (`on_preload`); once a source has
+    # been chained it is pre-buffered on a side thread and played without a gap,
+    # optionally crossfaded. `on_advance` fires from the audio thread after a handover.
+    def __init__(self, original, *, track, volume=0.5, offset=0.0):
+        _load_numpy()
+        self.original = original
+        self.track = track
+        self._volume = volume
+        self._gain = volume
+        self.offset = offset
+        self.frames = 0
+        self.next = None
+        self.on_preload = None
+        self.on_advance = None
+        self.on_drop = None
+        self.recovering = None
+        self.recoveries = 0
+        self.preload_requested = False
+        self.closed = False
+        self.buffer = deque()
+        self.buffer_lock = threading.Lock()
+        # Cleared while a prebuffer thread is reading `original`; the pipe has one reader.
+        self.prebuffered = threading.Event()
+        self.prebuffered.set()
+        self.processing_time = 0.0
+        self.processing_max = 0.0
+        self.processed_frames = 0
+        self.requested_at = None
+        self.last_read = None
+
+    @property
+    def title(self):
+        return self.track.title
+
+    @property
+    def url(self):
+        return self.track.webpage_url
+
+    @property
+    def duration(self):
+        return self.track.duration
+
+    @property
+    def thumbnail(self):
+        return self.track.thumbnail
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self._volume = max(value, 0.0)
+
+    @property
+    def position(self):
+        return self.offset + self.frames * FRAME_DURATION
+
+    @property
+    def remaining(self):
+        if not self.duration:
+            return None
+        return self.duration - self.position
+
+    def stats(self):
+        return {
+            "frames": self.processed_frames,
+            "avg_frame_time": self.processing_time / self.processed_frames if self.processed_frames else 0.0,
+            "max_frame_time": self.processing_max,
+        }
+
+    def chain(self, upcoming):
+        # Called from the event loop once the next track's source exists.
+        if self.closed:
+            upcoming.cleanup()
+            return
+        self.next = upcoming
+        upcoming.prebuffered.clear()
+        threading.Thread(target=upcoming.prebuffer, daemon=True).start()
+
+    def prebuffer(self, seconds=None):
+        # Pulls the first frames off the pipe so ffmpeg has connected before the handover.
+        # Frames are read outside the lock, so the audio thread only ever waits on an
+        # append; a handover closes this source and the loop stops after the frame in flight.
+        count = int((seconds or config.GAPLESS_PRELOAD) / FRAME_DURATION)
+        original = self.original
+        self.prebuffered.clear()
+        try:
+            while len(self.buffer) < count and not self.closed:
+                data = original.read()
+                if not data:
+                    break
+                with self.buffer_lock:
+                    self.buffer.append(data)
+        finally:
+            self.prebuffered.set()
+
+    def read_raw(self, wait=True):
+        with self.buffer_lock:
+            data = self.buffer.popleft() if self.buffer else None
+        if data is None:
+            if not self.prebuffered.is_set():
+                # The prebuffer is still reading the pipe: a crossfade skips this frame,
+                # a handover waits for the read in flight to land in the buffer.
+                if not wait:
+                    return b""
+                self.prebuffered.wait()
+                with self.buffer_lock:
+                    data = self.buffer.popleft() if self.buffer else None
+            if data is None:
+                original = self.original
+                # None once cleaned up or handed over: the stream has ended for this wrapper.
+                data = original.read() if original is not None else b""
+        if data:
+            self.frames += 1
+        return data
+
+    def read(self):
+        started = time.perf_counter()
+        remaining = self.remaining
+        if not self.preload_requested and remaining is not None and remaining <= config.GAPLESS_PRELOAD:
+            self.preload_requested = True
+            if self.on_preload:
+                self.on_preload(self)
+
+        data = self.read_raw()
+        if not data and stream_dropped(self):
+            # Cut off early: the chained track waits until this one has been recovered.
+            return SILENCE
+        upcoming = self.next
+        if len(data) < FRAME_SIZE and upcoming is not None:
+            # Current track drained: continue from the chained source in the same frame slot.
+            self._advance(upcoming)
+            return self.read()
+
+        frame = self._apply_gain(data)
+        if upcoming is not None and config.CROSSFADE and remaining is not None and remaining <= config.CROSSFADE:
+            frame = self._crossfade(frame, upcoming, remaining)
+
+        if metrics.enabled:
+            observe_frame(self)
+        elapsed = time.perf_counter() - started
+        self.processing_time += elapsed
+        self.processing_max = max(self.processing_max, elapsed)
+        self.processed_frames += 1
+        return frame
+
+    def _apply_gain(self, data):
+        target = self._volume
+        if not data or (self._gain == target == 1.0):
+            return data
+        samples = np.frombuffer(data, dtype=np.int16).reshape(-1, 2)
+        if self._gain == target:
+            scaled = samples * np.float32(target)
+        else:
+            step = FRAME_DURATION / config.VOLUME_RAMP if config.VOLUME_RAMP else 1.0
+            end = target if abs(target - self._gain) <= step else self._gain + step * np.sign(target - self._gain)
+            ramp = np.linspace(self._gain, end, len(samples), endpoint=False, dtype=np.float32)
+            scaled = samples * ramp[:, None]
+            self._gain = float(end)
+        return np.clip(scaled, -32768, 32767).astype(np.int16).tobytes()
+
+    def _crossfade(self, frame, upcoming, remaining):
+        incoming = upcoming._apply_gain(upcoming.read_raw(wait=False))
+        if not incoming:
+            return frame
+        # Equal-power curve across the crossfade window, sample-accurate within the frame.
+        start = 1.0 - remaining / config.CROSSFADE
+        size = min(len(frame), len(incoming)) // 4
+        t = np.linspace(start, start + FRAME_DURATION / config.CROSSFADE, size, endpoint=False, dtype=np.float32)
+        t = np.clip(t, 0.0, 1.0)[:, None]
+        outgoing = np.frombuffer(frame, dtype=np.int16, count=size * 2).reshape(-1, 2)
+        incoming_samples = np.frombuffer(incoming, dtype=np.int16, count=size * 2).reshape(-1, 2)
+        mixed = outgoing * np.cos(t * np.pi / 2) + incoming_samples * np.sin(t * np.pi / 2)
+        return np.clip(mixed, -32768, 32767).astype(np.int16).tobytes()
+
+    def _advance(self, upcoming):
+        previous = self.original
+        with self.buffer_lock, upcoming.buffer_lock:
+            self.original = upcoming.original
+            self.buffer = upcoming.buffer
+            self.prebuffered = upcoming.prebuffered
+            self.track = upcoming.track
+            self.offset = upcoming.offset
+            self.frames = upcoming.frames
+            self._volume = upcoming._volume
+            self._gain = upcoming._gain
+            self.next = None
+            self.preload_requested = False
+            self.recoveries = 0
+            # The wrapper no longer owns the stream; its cleanup (also run when it is
+            # garbage collected) must not kill the process that is now playing.
+            upcoming.original = None
+            upcoming.closed = True
+        previous.cleanup()
+        if self.on_advance:
+            self.on_advance(self)
+
+    def cleanup(self):
+        self.closed = True
+        original, self.original = self.original, None
+        if original is not None:
+            original.cleanup()
+        upcoming, self.next = self.next, None
+        if upcoming is not None:
+            upcoming.cleanup()
@@ -0,0 +1,234 @@
+# audiocache.py
+
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+log = logging.getLogger(__name__)
+
+INDEX_NAME = "index.sqlite3"
+# Downloads go to a subdirectory the cache creates, and only names yt-dlp leaves
+# behind there (partial downloads, audio the postprocessor didn't convert) are cleaned up.
+FILES_DIR = "tracks"
+LEFTOVER_SUFFIXES = (".opus", ".part", ".ytdl", ".temp", ".webm", ".m4a", ".mp4", ".ogg")
+# Play counts of tracks that never made it into the cache are forgotten after this long.
+PLAY_HISTORY = 30 * 86400
+
+# Like the extraction pool, each download worker process owns one YoutubeDL instance.
+_ytdl = None
+
+
+def _init_worker(options):
+    global _ytdl
+    import yt_dlp
+    _ytdl = yt_dlp.YoutubeDL(options)
+
+
+def _warm_up():
+    return _ytdl is not None
+
+
+def _download(url):
+    started = time.perf_counter()
+    info = _ytdl.extract_info(url, download=True)
+    # requested_downloads carries the path after FFmpegExtractAudio has run.
+    return info["requested_downloads"][0]["filepath"], time.perf_counter() - started
+
+
+class AudioCache:
+    # Optional on-disk tier for the hot set. Once a video has been played `min_plays`
+    # times it is downloaded in the background with the bot's yt-dlp options (the
+    # outtmpl/postprocessor pair, switched to Opus) and later plays read the local
+    # file: no extraction, no network, and in opus mode no ffmpeg at all. Admission is
+    # by play count, eviction least recently played first once the files exceed
+    # `max_bytes`. The index is SQLite in `directory`, keyed by video id; it also
+    # keeps play counts, so popularity survives restarts. `max_bytes=0` disables it.
+    def __init__(self, directory, ytdl_options, *, max_bytes=0, min_plays=3, max_duration=1200, downloads=1):
+        self.directory = os.path.abspath(directory)
+        self.files_dir = os.path.join(self.directory, FILES_DIR)
+        self.enabled = max_bytes > 0
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.max_duration = max_duration
+        self.workers = downloads
+        self.options = {
+            **ytdl_options,
+            "format": "bestaudio[acodec=opus]/bestaudio/best",
+            "outtmpl": os.path.join(self.files_dir, "%(id)s.%(ext)s"),
+            "postprocessors": [{"key": "FFmpegExtractAudio", "preferredcodec": "opus"}],
+            "noplaylist": True,
+        }
+        self.options.pop("extract_flat", None)
+        self.files = OrderedDict()
+        self.size = 0
+        self.pending = set()
+        self.failed = set()
+        self.hits = 0
+        self.misses = 0
+        self.downloads = 0
+        self.download_time = 0.0
+        self.failures = 0
+        self.evictions = 0
+        self._pool = None
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _open(self):
+        os.makedirs(self.files_dir, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(self.directory, INDEX_NAME), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tracks "
+            "(video_id TEXT PRIMARY KEY, plays INTEGER NOT NULL, last_played REAL NOT NULL, filename TEXT, size INTEGER)"
+        )
+        self._db.execute("DELETE FROM tracks WHERE filename IS NULL AND last_played < ?", (time.time() - PLAY_HISTORY,))
+        rows = self._db.execute(
+            "SELECT video_id, filename, size FROM tracks WHERE filename IS NOT NULL ORDER BY last_played"
+        ).fetchall()
+        for video_id, filename, size in rows:
+            path = os.path.join(self.files_dir, filename)
+            if os.path.exists(path):
+                self.files[video_id] = (path, size)
+                self.size += size
+            else:
+                self._db.execute("UPDATE tracks SET filename = NULL, size = NULL WHERE video_id = ?", (video_id,))
+        # Leftovers of downloads interrupted by a restart.
+        known = {os.path.basename(path) for path, _ in self.files.values()}
+        for name in os.listdir(self.files_dir):
+            path = os.path.join(self.files_dir, name)
+            if name not in known and name.endswith(LEFTOVER_SUFFIXES) and os.path.isfile(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        self._evict()
+
+    def start(self):
+        if not self.enabled:
+            return
+        # Opened here rather than on construction: a spawned process that re-imports the
+        # bot module must not sweep the directory while this one is downloading into it.
+        if self._db is None:
+            self._open()
+        if self._pool is None:
+            # The pool forks on its first submit, so it is warmed here, before voice threads exist.
+            context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+            self._pool = ProcessPoolExecutor(
+                self.workers, mp_context=context, initializer=_init_worker, initargs=(self.options,)
+            )
+            for _ in range(self.workers):
+                self._pool.submit(_warm_up)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def owns(self, url):
+        return bool(url) and url.startswith(self.files_dir + os.sep)
+
+    def lookup(self, video_id):
+        # Returns the local file for a cached video, or None.
+        if not self.enabled or not video_id:
+            return None
+        cached = self.files.get(video_id)
+        if cached is None or not os.path.exists(cached[0]):
+            if cached is not None:
+                self._drop(video_id)
+            self.misses += 1
+            return None
+        self.files.move_to_end(video_id)
+        self.hits += 1
+        return cached[0]
+
+    def played(self, track):
+        # Counts a play and queues the download once the track has earned a place.
+        if not self.enabled or not track.id:
+            return
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO tracks (video_id, plays, last_played) VALUES (?, 1, ?) "
+                "ON CONFLICT (video_id) DO UPDATE SET plays = plays + 1, last_played = excluded.last_played",
+                (track.id, time.time()),
+            )
+            plays = self._db.execute("SELECT plays FROM tracks WHERE video_id = ?", (track.id,)).fetchone()[0]
+        if track.id in self.files:
+            self.files.move_to_end(track.id)
+            return
+        # Live streams and very long mixes would only churn the cache.
+        if plays < self.min_plays or not track.duration or track.duration > self.max_duration:
+            return
+        if track.id in self.pending or track.id in self.failed or self._pool is None:
+            return
+        self.pending.add(track.id)
+        future = asyncio.get_running_loop().run_in_executor(self._pool, _download, track.webpage_url)
+        future.add_done_callback(functools.partial(self._downloaded, track.id))
+
+    def _downloaded(self, video_id, future):
+        self.pending.discard(video_id)
+        if future.cancelled():
+            return
+        try:
+            path, elapsed = future.result()
+            size = os.path.getsize(path)
+        except Exception as e:
+            # Not retried until restart; the track keeps streaming as before.
+            log.warning("could not cache %s: %s", video_id, e)
+            self.failed.add(video_id)
+            self.failures += 1
+            return
+        if size > self.max_bytes:
+            os.remove(path)
+            self.failed.add(video_id)
+            return
+        with self._lock:
+            self._db.execute(
+                "UPDATE tracks SET filename = ?, size = ? WHERE video_id = ?", (os.path.basename(path), size, video_id)
+            )
+        previous = self.files.pop(video_id, None)
+        if previous is not None:
+            self.size -= previous[1]
+        self.files[video_id] = (path, size)
+        self.size += size
+        self.downloads += 1
+        self.download_time += elapsed
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.files:
+            video_id = next(iter(self.files))
+            path, _ = self.files[video_id]
+            self._drop(video_id)
+            # A track still playing from it keeps reading: the file lives on until closed.
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.evictions += 1
+
+    def _drop(self, video_id):
+        _, size = self.files.pop(video_id)
+        self.size -= size
+        with self._lock:
+            self._db.execute("UPDATE tracks SET filename = NULL, size = NULL WHERE video_id = ?", (video_id,))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "files": len(self.files),
+            "size_mb": self.size / 2**20,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "downloads": self.downloads,
+            "avg_download_time": self.download_time / self.downloads if self.downloads else 0.0,
+            "pending": len(self.pending),
+            "failures": self.failures,
+            "evictions": self.evictions,
+        }
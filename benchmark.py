@@ -0,0 +1,1084 @@
+#!/usr/bin/env python3
+# benchmark.py
+#
+# Offline benchmark and load test for the playback pipeline. Nothing talks to
+# Discord or YouTube: a fake extractor returns canned extract_info dicts, a local
+# HTTP server serves generated audio, and a simulated voice client pulls frames
+# from the cog's sources on the real 20 ms schedule.
+#
+#   ./benchmark.py load --guilds 20 --playlist 200 --output results.json
+#   ./benchmark.py load --compare results.json
+#   ./benchmark.py scaling --workers 0,1,2,4 --output scaling.json
+#   ./benchmark.py burst --requests 500 --unique 5
+#   ./benchmark.py memory --tracks 10000
+#   ./benchmark.py recovery --guilds 5 --track-seconds 30 --cut 10
+#   ./benchmark.py gapless --guilds 5 --playlist 3 --track-seconds 10
+#   ./benchmark.py cache --guilds 10
+#   ./benchmark.py extract
+#
+# Requires ffmpeg and Linux (/proc is used for process accounting).
+
+import argparse
+import asyncio
+import importlib.util
+import io
+import json
+import math
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import discord
+from discord.player import OPUS_SILENCE
+
+os.environ.setdefault("BOT_OWNER_ID", "0")
+
+FRAME_INTERVAL = 0.02
+SAMPLE_RATE = 48000
+SILENCE = bytes(discord.opus.Encoder.FRAME_SIZE)
+
+
+def summarize(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {
+        "count": len(ordered),
+        "mean": statistics.fmean(ordered),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": ordered[-1],
+    }
+
+
+def generate_wav(seconds, frequency=440.0):
+    # A stereo 48 kHz sine; ffmpeg decodes it just like a remote stream.
+    frames = bytearray()
+    step = 2 * math.pi * frequency / SAMPLE_RATE
+    period = [int(12000 * math.sin(step * i)) for i in range(SAMPLE_RATE // int(frequency) * 10)]
+    sample = b"".join(v.to_bytes(2, "little", signed=True) * 2 for v in period)
+    total = seconds * SAMPLE_RATE * 4
+    while len(frames) < total:
+        frames += sample
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as out:
+        out.setnchannels(2)
+        out.setsampwidth(2)
+        out.setframerate(SAMPLE_RATE)
+        out.writeframes(bytes(frames[:total]))
+    return buffer.getvalue()
+
+
+class AudioServer:
+    # Serves the same generated file for every /audio/<id> path, with Range support
+    # so ffmpeg's reconnect and seek paths behave like they do against googlevideo.
+    # URLs carrying `cut=1` behave like a link that expires mid-stream: the response
+    # stops after `cut` seconds of audio and every later request for it gets a 403.
+    def __init__(self, seconds, cut=None):
+        body = generate_wav(seconds)
+        self.requests = 0
+        self.cuts = 0
+        expired = set()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(handler):
+                self.requests += 1
+                limit = None
+                if cut and "cut=1" in handler.path:
+                    if handler.path in expired:
+                        handler.send_error(403)
+                        return
+                    expired.add(handler.path)
+                    self.cuts += 1
+                    limit = 44 + int(cut * SAMPLE_RATE) * 4
+                    handler.close_connection = True
+                start, end = 0, len(body) - 1
+                header = handler.headers.get("Range")
+                if header and header.startswith("bytes="):
+                    first, _, last = header[6:].partition("-")
+                    start = int(first or 0)
+                    end = int(last) if last else end
+                    handler.send_response(206)
+                    handler.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+                else:
+                    handler.send_response(200)
+                handler.send_header("Content-Type", "audio/wav")
+                handler.send_header("Accept-Ranges", "bytes")
+                handler.send_header("Content-Length", str(end - start + 1))
+                handler.end_headers()
+                try:
+                    handler.wfile.write(body[start:end + 1] if limit is None else body[start:max(start, limit)])
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+
+
+class FakeExtractor:
+    # Stands in for ExtractionEngine. "playlist:<name>" queries return a flat
+    # playlist; anything else is treated as a single video and resolved to a
+    # stream URL on the local audio server.
+    def __init__(self, base_url, *, playlist_size, track_seconds, latency, cut=False):
+        self.base_url = base_url
+        self.playlist_size = playlist_size
+        self.track_seconds = track_seconds
+        self.latency = latency
+        # With `cut`, a video's first stream URL is one the audio server cuts off.
+        self.cut = cut
+        self.resolved = set()
+        self.calls = 0
+
+    def start(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def cancel(self, guild_id):
+        return 0
+
+    def stats(self):
+        return {"calls": self.calls}
+
+    async def extract(self, url, *, guild_id=None, admission=True, on_result=None):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        data = self.response(url)
+        if on_result is not None:
+            on_result(data)
+        return data
+
+    def response(self, url):
+        if url.startswith("playlist:"):
+            name = url.split(":", 1)[1]
+            return {
+                "_type": "playlist",
+                "id": name,
+                "title": name,
+                "entries": [
+                    {
+                        "_type": "url",
+                        "id": f"{name}-{i}",
+                        "title": f"{name} track {i}",
+                        "duration": self.track_seconds,
+                        "url": f"https://www.youtube.com/watch?v={name}-{i}",
+                    }
+                    for i in range(self.playlist_size)
+                ],
+            }
+        video_id = url.rsplit("=", 1)[-1].rsplit("/", 1)[-1]
+        stream_url = f"{self.base_url}/audio/{video_id}?expire={int(time.time()) + 21600}"
+        if self.cut and video_id not in self.resolved:
+            stream_url += "&cut=1"
+        self.resolved.add(video_id)
+        return {
+            "id": video_id,
+            "title": f"track {video_id}",
+            "duration": self.track_seconds,
+            "webpage_url": url,
+            "url": stream_url,
+            "acodec": "pcm_s16le",
+            "asr": SAMPLE_RATE,
+        }
+
+
+def opus_available():
+    try:
+        discord.opus._load_default()
+    except Exception:
+        pass
+    return discord.opus.is_loaded()
+
+
+class FakeVoiceClient:
+    # Mirrors discord.py's AudioPlayer loop: read a frame, Opus-encode it if the
+    # source is PCM (when libopus is available), sleep until the next 20 ms slot,
+    # call `after` and clean up the source when it runs dry. Like VoiceClient.source,
+    # assigning `source` while playing swaps what the running loop reads from.
+    def __init__(self):
+        self.encoder = discord.opus.Encoder() if opus_available() else None
+        self.channel = type("VoiceChannel", (), {"id": 0})()
+        self.first_frame = None
+        self.intervals = []
+        self.read_times = []
+        self.frames = 0
+        self.silent_frames = 0
+        self.errors = []
+        self._player = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    @property
+    def source(self):
+        return self._player.source if self._player else None
+
+    @source.setter
+    def source(self, value):
+        self._player.source = value
+
+    def is_playing(self):
+        return self._thread is not None and self._thread.is_alive() and not self._stopped.is_set()
+
+    def is_paused(self):
+        return False
+
+    def play(self, source, *, after=None):
+        self._player = type("AudioPlayer", (), {"source": source})()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._player, self._stopped, after), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+
+    async def move_to(self, channel):
+        pass
+
+    def _run(self, player, stopped, after):
+        start = time.perf_counter()
+        previous = None
+        loops = 0
+        while not stopped.is_set():
+            began = time.perf_counter()
+            source = player.source
+            try:
+                data = source.read()
+            except Exception as e:
+                # AudioPlayer ends the track on a read error, as if the source ran dry.
+                self.errors.append(f"{type(e).__name__}: {e}")
+                break
+            if not data:
+                break
+            if data in (SILENCE, OPUS_SILENCE):
+                self.silent_frames += 1
+            if self.encoder is not None and not source.is_opus():
+                self.encoder.encode(data, self.encoder.SAMPLES_PER_FRAME)
+            finished = time.perf_counter()
+            self.read_times.append(finished - began)
+            if self.first_frame is None:
+                self.first_frame = finished
+            if previous is not None:
+                self.intervals.append(finished - previous)
+            previous = finished
+            self.frames += 1
+            loops += 1
+            time.sleep(max(0.0, start + FRAME_INTERVAL * loops - time.perf_counter()))
+        stopped.set()
+        if after is not None:
+            after(None)
+        player.source.cleanup()
+
+
+class FakeContext:
+    def __init__(self, guild_id):
+        self.voice_client = FakeVoiceClient()
+        self.guild = type("Guild", (), {"id": guild_id, "voice_client": self.voice_client})()
+        self.author = type("Author", (), {"voice": None})()
+        self.id = guild_id
+        self.channel = self
+        self.messages = []
+
+    async def send(self, content=None, *, embed=None):
+        self.messages.append((time.perf_counter(), embed.title if embed else content))
+
+    def typing(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeBot:
+    def __init__(self, loop):
+        self.loop = loop
+        self.user = None
+        self.voice_clients = []
+        self.presence_updates = 0
+
+    async def change_presence(self, **kwargs):
+        self.presence_updates += 1
+
+
+def load_module(path):
+    spec = importlib.util.spec_from_file_location("bench_target", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def proc_stat(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        raw = f.read()
+    comm = raw[raw.index("(") + 1:raw.rindex(")")]
+    fields = raw[raw.rindex(")") + 2:].split()
+    with open(f"/proc/{pid}/statm") as f:
+        rss_pages = int(f.read().split()[1])
+    ticks = os.sysconf("SC_CLK_TCK")
+    return {
+        "comm": comm,
+        "ppid": int(fields[1]),
+        "cpu": (int(fields[11]) + int(fields[12])) / ticks,
+        "rss": rss_pages * os.sysconf("SC_PAGE_SIZE"),
+    }
+
+
+def descendants():
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                parents[int(entry)] = proc_stat(int(entry))
+            except (FileNotFoundError, ProcessLookupError, ValueError, IndexError):
+                pass
+    found, frontier = {}, {os.getpid()}
+    while frontier:
+        children = {pid for pid, stat in parents.items() if stat["ppid"] in frontier and pid not in found}
+        found.update((pid, parents[pid]) for pid in children)
+        frontier = children
+    return found
+
+
+class ResourceSampler:
+    # Samples our own CPU/RSS plus every descendant (ffmpeg, pool workers) from /proc.
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.child_cpu = {}
+        self.ffmpeg_counts = []
+        self.rss = []
+        self.cpu_start = time.process_time()
+        self.cpu_end = None
+
+    def sample(self):
+        children = descendants()
+        for pid, stat in children.items():
+            self.child_cpu[pid] = stat["cpu"]
+        self.ffmpeg_counts.append(sum(1 for stat in children.values() if stat["comm"] == "ffmpeg"))
+        own = proc_stat(os.getpid())
+        self.rss.append(own["rss"] + sum(stat["rss"] for stat in children.values()))
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    @property
+    def cpu_seconds(self):
+        return (self.cpu_end or time.process_time()) - self.cpu_start + sum(self.child_cpu.values())
+
+
+async def run_guild(cog, ctx, args, results):
+    started = time.perf_counter()
+    await cog.play(ctx, query=f"playlist:guild{ctx.guild.id}")
+    added = next((at for at, title in ctx.messages if title in ("Playlist Added", "Song Added")), None)
+    if added is not None:
+        results["enqueue_latency"].append(added - started)
+    while ctx.voice_client.first_frame is None and time.perf_counter() - started < args.timeout:
+        await asyncio.sleep(0.005)
+    if ctx.voice_client.first_frame is not None:
+        results["time_to_first_audio"].append(ctx.voice_client.first_frame - started)
+
+    await asyncio.sleep(args.play_seconds)
+    for name, attribute in (("queue", "queue_info"), ("skip", "skip")):
+        began = time.perf_counter()
+        await getattr(cog, attribute)(ctx)
+        results["commands"].setdefault(name, []).append(time.perf_counter() - began)
+    await asyncio.sleep(args.play_seconds)
+    began = time.perf_counter()
+    await cog.stop(ctx)
+    results["commands"].setdefault("stop", []).append(time.perf_counter() - began)
+
+
+async def load_test(args):
+    module = load_module(args.module)
+    with AudioServer(args.track_seconds) as server:
+        extractor = FakeExtractor(
+            server.base_url, playlist_size=args.playlist, track_seconds=args.track_seconds, latency=args.extract_latency
+        )
+        module.extraction_engine = extractor
+        module.extraction_cache = module.ExtractionCache(":memory:")
+        module.snapshot_store = module.SnapshotStore(":memory:")
+        bot = FakeBot(asyncio.get_running_loop())
+        cog = module.MusicCog(bot)
+        for command in cog.get_commands():
+            # What Bot.add_cog would do, without needing a gateway connection.
+            command.cog = cog
+        await cog.cog_load()
+        contexts = [FakeContext(guild_id) for guild_id in range(1, args.guilds + 1)]
+        results = {"enqueue_latency": [], "time_to_first_audio": [], "commands": {}}
+
+        sampler = ResourceSampler()
+        sampling = asyncio.create_task(sampler.run())
+        wall_start = time.perf_counter()
+        await asyncio.gather(*(run_guild(cog, ctx, args, results) for ctx in contexts))
+        wall = time.perf_counter() - wall_start
+        sampler.cpu_end = time.process_time()
+        sampling.cancel()
+        await asyncio.sleep(0.5)
+        sampler.sample()
+        await cog.cog_unload()
+
+    intervals = [i for ctx in contexts for i in ctx.voice_client.intervals]
+    jitter = [abs(i - FRAME_INTERVAL) * 1000 for i in intervals]
+    stream_seconds = sum(ctx.voice_client.frames for ctx in contexts) * FRAME_INTERVAL
+    return {
+        "version": git_version(),
+        "module": os.path.basename(args.module),
+        "settings": {
+            "guilds": args.guilds,
+            "playlist": args.playlist,
+            "track_seconds": args.track_seconds,
+            "extract_latency": args.extract_latency,
+            "playback_mode": module.config.PLAYBACK_MODE,
+            "audio_workers": module.config.AUDIO_WORKERS,
+            "opus_encoding": opus_available(),
+        },
+        "wall_seconds": wall,
+        "enqueue_latency": summarize(results["enqueue_latency"]),
+        "time_to_first_audio": summarize(results["time_to_first_audio"]),
+        "frame_jitter_ms": summarize(jitter),
+        "frame_read_ms": summarize([t * 1000 for ctx in contexts for t in ctx.voice_client.read_times]),
+        "late_frames": sum(1 for i in intervals if i > FRAME_INTERVAL * 1.5),
+        "frames": sum(ctx.voice_client.frames for ctx in contexts),
+        "cpu_per_stream": sampler.cpu_seconds / stream_seconds if stream_seconds else None,
+        "ffmpeg_processes": summarize(sampler.ffmpeg_counts),
+        "rss_mb": summarize([rss / 2**20 for rss in sampler.rss]),
+        "commands": {name: summarize(values) for name, values in results["commands"].items()},
+        "extractions": extractor.calls,
+        "presence_updates": bot.presence_updates,
+    }
+
+
+async def recovery_run(module, args, attempts):
+    module.config.RECOVERY_ATTEMPTS = attempts
+    with AudioServer(args.track_seconds, cut=args.cut) as server:
+        extractor = FakeExtractor(
+            server.base_url, playlist_size=1, track_seconds=args.track_seconds, latency=args.extract_latency, cut=True
+        )
+        module.extraction_engine = extractor
+        module.extraction_cache = module.ExtractionCache(":memory:")
+        module.snapshot_store = module.SnapshotStore(":memory:")
+        cog = module.MusicCog(FakeBot(asyncio.get_running_loop()))
+        for command in cog.get_commands():
+            command.cog = cog
+        await cog.cog_load()
+        contexts = [FakeContext(guild_id) for guild_id in range(1, args.guilds + 1)]
+        for ctx in contexts:
+            await cog.play(ctx, query=f"https://www.youtube.com/watch?v=recovery-{ctx.guild.id}")
+        deadline = time.perf_counter() + args.track_seconds * 2 + args.timeout
+        while any(ctx.voice_client.is_playing() for ctx in contexts) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.1)
+        players = list(cog.players.values())
+        await cog.cog_unload()
+    played = [(ctx.voice_client.frames - ctx.voice_client.silent_frames) * FRAME_INTERVAL for ctx in contexts]
+    recoveries = sum(player.recoveries for player in players)
+    return {
+        "recovery_attempts": attempts,
+        "played_seconds": summarize(played),
+        "completed": sum(1 for seconds in played if seconds >= args.track_seconds - 1) / len(contexts),
+        "silence_seconds": summarize([ctx.voice_client.silent_frames * FRAME_INTERVAL for ctx in contexts]),
+        "recoveries": recoveries,
+        "recovery_failures": sum(player.recovery_failures for player in players),
+        "avg_recovery_seconds": sum(player.recovery_seconds for player in players) / recoveries if recoveries else None,
+        "stream_cuts": server.cuts,
+        "extractions": extractor.calls,
+    }
+
+
+async def recovery_test(args):
+    # Every guild plays one track whose first stream URL dies `cut` seconds in, once
+    # with recovery disabled and once with the configured attempts.
+    module = load_module(args.module)
+    attempts = module.config.RECOVERY_ATTEMPTS
+    return {
+        "version": git_version(),
+        "settings": {
+            "guilds": args.guilds,
+            "track_seconds": args.track_seconds,
+            "cut": args.cut,
+            "extract_latency": args.extract_latency,
+            "playback_mode": module.config.PLAYBACK_MODE,
+            "audio_workers": module.config.AUDIO_WORKERS,
+        },
+        "without_recovery": await recovery_run(module, args, 0),
+        "with_recovery": await recovery_run(module, args, attempts),
+    }
+
+
+async def gapless_test(args):
+    # Every guild plays a whole playlist without skipping, so each track after the first
+    # is reached through the mixer's handover (or, with --loop track, the same track
+    # re-armed). The other benchmarks skip or stop before the preload point. With
+    # --cut, each track's first stream dies that many seconds in, e.g. after the next
+    # track has been chained.
+    module = load_module(args.module)
+    with AudioServer(args.track_seconds, cut=args.cut) as server:
+        extractor = FakeExtractor(
+            server.base_url, playlist_size=args.playlist, track_seconds=args.track_seconds, latency=args.extract_latency,
+            cut=bool(args.cut),
+        )
+        module.extraction_engine = extractor
+        module.extraction_cache = module.ExtractionCache(":memory:")
+        module.snapshot_store = module.SnapshotStore(":memory:")
+        cog = module.MusicCog(FakeBot(asyncio.get_running_loop()))
+        for command in cog.get_commands():
+            command.cog = cog
+        await cog.cog_load()
+        contexts = [FakeContext(guild_id) for guild_id in range(1, args.guilds + 1)]
+        for ctx in contexts:
+            await cog.play(ctx, query=f"playlist:gapless{ctx.guild.id}")
+            cog.players[ctx.guild.id].loop_mode = args.loop
+        # Crossfaded tracks overlap by CROSSFADE seconds at each handover.
+        expected = args.playlist * args.track_seconds - (args.playlist - 1) * module.config.CROSSFADE
+        played = lambda ctx: (ctx.voice_client.frames - ctx.voice_client.silent_frames) * FRAME_INTERVAL
+        deadline = time.perf_counter() + expected + args.timeout
+        while time.perf_counter() < deadline:
+            if args.loop == "off" and not any(ctx.voice_client.is_playing() for ctx in contexts):
+                break
+            if args.loop == "track" and all(played(ctx) >= expected for ctx in contexts):
+                break
+            await asyncio.sleep(0.1)
+        players = list(cog.players.values())
+        for ctx in contexts:
+            await cog.stop(ctx)
+        await cog.cog_unload()
+    played = [played(ctx) for ctx in contexts]
+    return {
+        "version": git_version(),
+        "module": os.path.basename(args.module),
+        "settings": {
+            "guilds": args.guilds,
+            "playlist": args.playlist,
+            "track_seconds": args.track_seconds,
+            "loop": args.loop,
+            "cut": args.cut,
+            "playback_mode": module.config.PLAYBACK_MODE,
+            "audio_workers": module.config.AUDIO_WORKERS,
+            "crossfade": module.config.CROSSFADE,
+        },
+        "expected_seconds": expected,
+        "played_seconds": summarize(played),
+        "completed": sum(1 for seconds in played if seconds >= expected - 1) / len(contexts),
+        "silence_seconds": summarize([ctx.voice_client.silent_frames * FRAME_INTERVAL for ctx in contexts]),
+        "read_errors": [error for ctx in contexts for error in ctx.voice_client.errors],
+        "recoveries": sum(player.recoveries for player in players),
+        "extractions": extractor.calls,
+    }
+
+
+async def cache_round(cog, args, first_guild):
+    contexts = [FakeContext(first_guild + index) for index in range(args.guilds)]
+    latencies = []
+
+    async def play(index, ctx):
+        started = time.perf_counter()
+        await cog.play(ctx, query=f"https://www.youtube.com/watch?v=cache-{index}")
+        while ctx.voice_client.first_frame is None and time.perf_counter() - started < args.timeout:
+            await asyncio.sleep(0.005)
+        if ctx.voice_client.first_frame is not None:
+            latencies.append(ctx.voice_client.first_frame - started)
+        await asyncio.sleep(args.play_seconds)
+        await cog.stop(ctx)
+
+    sampler = ResourceSampler(interval=0.2)
+    sampling = asyncio.create_task(sampler.run())
+    await asyncio.gather(*(play(index, ctx) for index, ctx in enumerate(contexts)))
+    sampler.cpu_end = time.process_time()
+    sampling.cancel()
+    stream_seconds = sum(ctx.voice_client.frames for ctx in contexts) * FRAME_INTERVAL
+    return {
+        "time_to_first_audio": summarize(latencies),
+        "cpu_per_stream": sampler.cpu_seconds / stream_seconds if stream_seconds else None,
+        "ffmpeg_processes": summarize(sampler.ffmpeg_counts),
+    }
+
+
+async def cache_test(args):
+    # Plays the same tracks twice in fresh guilds: first streamed from the local audio
+    # server (the audio cache downloads them after that play), then from the cache.
+    # Downloads are an ffmpeg transcode from the audio server instead of yt-dlp.
+    import audiocache
+    from concurrent.futures import ThreadPoolExecutor
+
+    module = load_module(args.module)
+    directory = tempfile.mkdtemp(prefix="audio-cache-")
+    with AudioServer(args.track_seconds) as server:
+
+        def download(url):
+            started = time.perf_counter()
+            video_id = url.rsplit("=", 1)[-1]
+            path = os.path.join(module.audio_cache.files_dir, f"{video_id}.opus")
+            subprocess.run(
+                ["ffmpeg", "-loglevel", "error", "-y", "-i", f"{server.base_url}/audio/{video_id}", "-c:a", "libopus", path],
+                check=True,
+            )
+            return path, time.perf_counter() - started
+
+        audiocache._download = download
+        extractor = FakeExtractor(
+            server.base_url, playlist_size=1, track_seconds=args.track_seconds, latency=args.extract_latency
+        )
+        module.extraction_engine = extractor
+        module.extraction_cache = module.ExtractionCache(":memory:")
+        module.snapshot_store = module.SnapshotStore(":memory:")
+        module.audio_cache = module.AudioCache(directory, module.ytdl_format_options, max_bytes=2**30, min_plays=1)
+        module.audio_cache._pool = ThreadPoolExecutor(2)
+        cog = module.MusicCog(FakeBot(asyncio.get_running_loop()))
+        for command in cog.get_commands():
+            command.cog = cog
+        await cog.cog_load()
+        streamed = await cache_round(cog, args, 1)
+        while module.audio_cache.pending:
+            await asyncio.sleep(0.05)
+        cached = await cache_round(cog, args, 1 + args.guilds)
+        cache_stats = module.audio_cache.stats()
+        await cog.cog_unload()
+    shutil.rmtree(directory, ignore_errors=True)
+    return {
+        "version": git_version(),
+        "module": os.path.basename(args.module),
+        "settings": {
+            "guilds": args.guilds,
+            "track_seconds": args.track_seconds,
+            "play_seconds": args.play_seconds,
+            "extract_latency": args.extract_latency,
+            "playback_mode": module.config.PLAYBACK_MODE,
+            "audio_workers": module.config.AUDIO_WORKERS,
+        },
+        "streamed": streamed,
+        "cached": cached,
+        "audio_cache": cache_stats,
+    }
+
+
+async def extract_test(args):
+    # One real extract_info through the module's ExtractionEngine: a pool worker runs
+    # yt-dlp's generic extractor against the local audio server. The other benchmarks
+    # swap the engine or its pool out, so this is what catches a pool that can't run
+    # jobs at all (worker start-up, pickling of the task functions).
+    module = load_module(args.module)
+    engine = module.extraction_engine
+    data, error = None, None
+    with AudioServer(3) as server:
+        engine.start()
+        started = time.perf_counter()
+        try:
+            data = await asyncio.wait_for(engine.extract(f"{server.base_url}/audio/check", admission=False), args.timeout)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        elapsed = time.perf_counter() - started
+        engine.shutdown()
+    return {
+        "version": git_version(),
+        "module": os.path.basename(args.module),
+        "ok": bool(data and data.get("url")),
+        "seconds": elapsed,
+        "error": error,
+    }
+
+
+def open_stream(pool, url, index):
+    if pool is None:
+        # What the in-process PCM path costs per frame: ffmpeg pipe read plus volume.
+        return discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(url, options="-loglevel error"), volume=0.5)
+    from tracks import Track
+    track = Track({"id": f"stream-{index}", "title": f"stream {index}", "url": url})
+    return pool.open(track, guild_id=index, options="-loglevel error")
+
+
+def run_streams(pool, url, streams, seconds, warmup=50):
+    clients = [FakeVoiceClient() for _ in range(streams)]
+    cpu_start = time.process_time()
+    for index, client in enumerate(clients):
+        client.play(open_stream(pool, f"{url}/audio/{index}", index))
+    time.sleep(seconds)
+    for client in clients:
+        client.stop()
+    for client in clients:
+        client._thread.join()
+    cpu = time.process_time() - cpu_start
+    # The first second is ffmpeg start-up for every stream at once; judge steady state.
+    intervals = [i for client in clients for i in client.intervals[warmup:]]
+    late = sum(1 for i in intervals if i > FRAME_INTERVAL * 1.5)
+    return {
+        "streams": streams,
+        "late_ratio": late / len(intervals) if intervals else 1.0,
+        "frame_jitter_ms": summarize([abs(i - FRAME_INTERVAL) * 1000 for i in intervals]),
+        "gateway_cpu": cpu / seconds,
+    }
+
+
+def scaling_test(args):
+    from workers import AudioWorkerPool
+    counts = [int(count) for count in args.workers.split(",")] if args.workers else (
+        [0] + [2 ** i for i in range(os.cpu_count().bit_length()) if 2 ** i <= os.cpu_count()]
+    )
+    runs, capacity = [], {}
+    with AudioServer(int(args.seconds) + 5) as server:
+        for count in counts:
+            pool = None
+            if count:
+                pool = AudioWorkerPool(count)
+                pool.start()
+            try:
+                # Ramp up until more than late_threshold of frames miss their slot.
+                capacity[str(count)] = 0
+                for streams in range(args.step, args.max_streams + 1, args.step):
+                    run = run_streams(pool, server.base_url, streams, args.seconds)
+                    run["workers"] = count
+                    runs.append(run)
+                    print(f"workers={count} streams={streams} late={run['late_ratio']:.2%}", file=sys.stderr)
+                    if run["late_ratio"] > args.late_threshold:
+                        break
+                    capacity[str(count)] = streams
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+    baseline = capacity.get("0") or capacity.get("1")
+    return {
+        "version": git_version(),
+        "cpu_count": os.cpu_count(),
+        "settings": {
+            "seconds": args.seconds,
+            "step": args.step,
+            "max_streams": args.max_streams,
+            "late_threshold": args.late_threshold,
+            "opus_encoding": opus_available(),
+        },
+        "capacity": capacity,
+        "speedup": {count: streams / baseline for count, streams in capacity.items()} if baseline else None,
+        "runs": runs,
+    }
+
+
+async def burst_test(args):
+    # Drives YTDLSource.from_url with the module's real ExtractionEngine (admission
+    # limits from config), swapping only the process pool for threads and
+    # extract_info for a sleep, then counts how many extractions the burst cost.
+    import extraction
+    from concurrent.futures import ThreadPoolExecutor
+
+    fake = FakeExtractor("http://127.0.0.1:9", playlist_size=1, track_seconds=60, latency=args.extract_latency)
+    calls = []
+
+    def extract(url):
+        calls.append(url)
+        time.sleep(fake.latency)
+        return fake.response(url), fake.latency
+
+    extraction._extract = extract
+    module = load_module(args.module)
+    engine = module.extraction_engine
+    pool = ThreadPoolExecutor(engine.workers)
+    engine.start = lambda: pool
+    module.extraction_cache = module.ExtractionCache(":memory:")
+    # 11-character ids, so every request is a canonical YouTube watch URL.
+    urls = [f"https://www.youtube.com/watch?v=burst{i:06d}" for i in range(args.unique)]
+    latencies, busy, failed = [], 0, 0
+
+    async def request(index):
+        nonlocal busy, failed
+        await asyncio.sleep(args.spread * index / args.requests)
+        started = time.perf_counter()
+        try:
+            await module.YTDLSource.from_url(urls[index % len(urls)], guild_id=index % args.guilds)
+            latencies.append(time.perf_counter() - started)
+        except module.ExtractionBusy:
+            busy += 1
+        except Exception:
+            failed += 1
+
+    began = time.perf_counter()
+    await asyncio.gather(*(request(index) for index in range(args.requests)))
+    wall = time.perf_counter() - began
+    pool.shutdown()
+    return {
+        "version": git_version(),
+        "module": os.path.basename(args.module),
+        "settings": {
+            "requests": args.requests,
+            "unique": args.unique,
+            "guilds": args.guilds,
+            "spread": args.spread,
+            "extract_latency": args.extract_latency,
+            "workers": engine.workers,
+            "rate": engine.bucket.rate,
+            "guild_rate": engine.guild_rate,
+            "queue_limit": engine.queue_limit,
+        },
+        "wall_seconds": wall,
+        "extractions": len(calls),
+        "unique_extracted": len(set(calls)),
+        "served": len(latencies),
+        "busy": busy,
+        "failed": failed,
+        "latency": summarize(latencies),
+        "engine": engine.stats(),
+    }
+
+
+def synthetic_info(index, formats, captions):
+    # Shaped like a real single-video extract_info result: a few hundred formats'
+    # worth of signed URLs and headers, thumbnails, captions and a long description.
+    video_id = f"mem{index:08d}"
+    stream = "https://rr1---sn-example.googlevideo.com/videoplayback?" + "&".join(
+        f"p{i}={video_id}{'x' * 24}" for i in range(30)
+    ) + f"&expire={int(time.time()) + 21600}"
+    headers = {
+        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+        "Accept-Language": "en-us,en;q=0.5",
+        "Sec-Fetch-Mode": "navigate",
+    }
+    return {
+        "id": video_id,
+        "title": f"Synthetic track {index}",
+        "duration": 213,
+        "thumbnail": f"https://i.ytimg.com/vi/{video_id}/maxresdefault.jpg",
+        "webpage_url": f"https://www.youtube.com/watch?v={video_id}",
+        "original_url": f"https://www.youtube.com/watch?v={video_id}",
+        "url": stream,
+        "acodec": "opus",
+        "asr": 48000,
+        "description": f"{video_id} " * 300,
+        "tags": [f"tag{i}" for i in range(30)],
+        "formats": [
+            {
+                "format_id": str(i), "url": f"{stream}&itag={i}", "ext": "webm", "acodec": "opus", "vcodec": "none",
+                "abr": 160.0, "asr": 48000, "filesize": 3400000 + i, "protocol": "https", "format_note": "medium",
+                "http_headers": dict(headers), "downloader_options": {"http_chunk_size": 10485760},
+            }
+            for i in range(formats)
+        ],
+        "thumbnails": [
+            {"url": f"https://i.ytimg.com/vi/{video_id}/{i}.jpg", "preference": -i, "id": str(i), "height": 90, "width": 120}
+            for i in range(40)
+        ],
+        "automatic_captions": {
+            f"l{lang}": [
+                {"ext": ext, "url": f"https://www.youtube.com/api/timedtext?v={video_id}&lang=l{lang}&fmt={ext}", "name": f"Language {lang}"}
+                for ext in ("json3", "srv1", "srv2", "srv3", "ttml", "vtt")
+            ]
+            for lang in range(captions)
+        },
+    }
+
+
+class RetainedTrack:
+    # What the queue used to hold: the source's handful of attributes plus the whole info dict.
+    def __init__(self, data):
+        self.data = data
+        self.title = data.get("title")
+        self.url = data.get("url")
+        self.duration = data.get("duration")
+        self.thumbnail = data.get("thumbnail")
+
+
+def measure_tracks(mode, args, conn):
+    import gc
+    from extraction import slim
+    from tracks import Track
+
+    gc.collect()
+    before = proc_stat(os.getpid())["rss"]
+    started = time.perf_counter()
+    tracks = []
+    for index in range(args.tracks):
+        info = synthetic_info(index, args.formats, args.captions)
+        tracks.append(RetainedTrack(info) if mode == "retained" else Track(slim(info)))
+        del info
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    grown = proc_stat(os.getpid())["rss"] - before
+    conn.send({"rss_mb": grown / 2**20, "bytes_per_track": grown / args.tracks, "build_seconds": elapsed})
+    conn.close()
+
+
+def memory_test(args):
+    # Each representation is built in a fresh forked process so one can't reuse the
+    # other's freed arenas; the figure is RSS growth after 10k (by default) tracks.
+    import multiprocessing
+    context = multiprocessing.get_context("fork")
+    results = {}
+    for mode in ("retained", "compact"):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=measure_tracks, args=(mode, args, sender))
+        process.start()
+        sender.close()
+        results[mode] = receiver.recv()
+        process.join()
+    return {
+        "version": git_version(),
+        "settings": {"tracks": args.tracks, "formats": args.formats, "captions": args.captions},
+        "sample_info_kb": len(json.dumps(synthetic_info(0, args.formats, args.captions))) / 1024,
+        "retained": results["retained"],
+        "compact": results["compact"],
+        "reduction": 1 - results["compact"]["rss_mb"] / results["retained"]["rss_mb"] if results["retained"]["rss_mb"] else None,
+    }
+
+
+def git_version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(result, prefix=""):
+    for key, value in result.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{key}", value
+
+
+def compare(baseline, current):
+    old = dict(flatten(baseline))
+    for key, value in flatten(current):
+        if key in old:
+            before = old[key]
+            change = f"{(value - before) / before:+.1%}" if before else "n/a"
+            print(f"{key:40} {before:>14.4f} {value:>14.4f} {change:>9}")
+
+
+def emit(result, args):
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), result)
+
+
+def main():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--output", help="write JSON results here instead of stdout")
+    common.add_argument("--compare", help="previous JSON results to diff against")
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the music bot playback pipeline.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    load = commands.add_parser("load", parents=[common], help="drive play/queue/skip/stop for N simulated guilds")
+    load.add_argument("--module", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "music.py"))
+    load.add_argument("--guilds", type=int, default=10)
+    load.add_argument("--playlist", type=int, default=100, help="entries per guild playlist")
+    load.add_argument("--track-seconds", type=int, default=20)
+    load.add_argument("--play-seconds", type=float, default=5.0, help="playback before skipping, then before stopping")
+    load.add_argument("--extract-latency", type=float, default=0.2, help="simulated extract_info latency")
+    load.add_argument("--timeout", type=float, default=30.0)
+
+    scaling = commands.add_parser(
+        "scaling", parents=[common], help="find how many concurrent streams each audio worker count sustains"
+    )
+    scaling.add_argument("--workers", help="comma-separated worker counts; 0 is in-process (default: 0,1,2,4.. up to cores)")
+    scaling.add_argument("--step", type=int, default=8, help="streams added per ramp step")
+    scaling.add_argument("--max-streams", type=int, default=256)
+    scaling.add_argument("--seconds", type=float, default=5.0, help="playback per ramp step")
+    scaling.add_argument("--late-threshold", type=float, default=0.01, help="fraction of late frames that counts as saturated")
+
+    burst = commands.add_parser("burst", parents=[common], help="many guilds ?play the same few links at once")
+    burst.add_argument("--module", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "music.py"))
+    burst.add_argument("--requests", type=int, default=500)
+    burst.add_argument("--unique", type=int, default=5, help="distinct URLs among the requests")
+    burst.add_argument("--guilds", type=int, default=100)
+    burst.add_argument("--spread", type=float, default=2.0, help="seconds over which the requests arrive")
+    burst.add_argument("--extract-latency", type=float, default=1.0, help="simulated extract_info latency")
+
+    memory = commands.add_parser("memory", parents=[common], help="RSS of queued tracks: full info dicts vs compact records")
+    memory.add_argument("--tracks", type=int, default=10000)
+    memory.add_argument("--formats", type=int, default=20, help="formats per synthetic info dict")
+    memory.add_argument("--captions", type=int, default=20, help="caption languages per synthetic info dict")
+
+    recovery = commands.add_parser("recovery", parents=[common], help="play tracks whose stream URL expires mid-track")
+    recovery.add_argument("--module", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "music.py"))
+    recovery.add_argument("--guilds", type=int, default=5)
+    recovery.add_argument("--track-seconds", type=int, default=30)
+    recovery.add_argument("--cut", type=float, default=10.0, help="seconds into the track the first stream URL dies")
+    recovery.add_argument("--extract-latency", type=float, default=0.2, help="simulated extract_info latency")
+    recovery.add_argument("--timeout", type=float, default=30.0)
+
+    gapless = commands.add_parser("gapless", parents=[common], help="play whole playlists through their track handovers")
+    gapless.add_argument("--module", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "music.py"))
+    gapless.add_argument("--guilds", type=int, default=5)
+    gapless.add_argument("--playlist", type=int, default=3, help="entries per guild playlist")
+    # Longer than GAPLESS_PRELOAD, so handovers happen while ffmpeg still has audio to send.
+    gapless.add_argument("--track-seconds", type=int, default=10)
+    gapless.add_argument("--loop", choices=("off", "track"), default="off")
+    gapless.add_argument("--cut", type=float, help="seconds into each track its first stream URL dies")
+    gapless.add_argument("--extract-latency", type=float, default=0.2, help="simulated extract_info latency")
+    gapless.add_argument("--timeout", type=float, default=30.0)
+
+    cache = commands.add_parser("cache", parents=[common], help="start-up and CPU of streamed vs locally cached tracks")
+    cache.add_argument("--module", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "music.py"))
+    cache.add_argument("--guilds", type=int, default=10)
+    cache.add_argument("--track-seconds", type=int, default=20)
+    cache.add_argument("--play-seconds", type=float, default=5.0)
+    cache.add_argument("--extract-latency", type=float, default=0.2, help="simulated extract_info latency")
+    cache.add_argument("--timeout", type=float, default=30.0)
+
+    extract = commands.add_parser("extract", parents=[common], help="run one real extraction through the worker pool")
+    extract.add_argument("--module", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "music.py"))
+    extract.add_argument("--timeout", type=float, default=60.0)
+
+    args = parser.parse_args()
+    if args.command == "load":
+        emit(asyncio.run(load_test(args)), args)
+    elif args.command == "scaling":
+        emit(scaling_test(args), args)
+    elif args.command == "burst":
+        emit(asyncio.run(burst_test(args)), args)
+    elif args.command == "memory":
+        emit(memory_test(args), args)
+    elif args.command == "recovery":
+        emit(asyncio.run(recovery_test(args)), args)
+    elif args.command == "gapless":
+        result = asyncio.run(gapless_test(args))
+        emit(result, args)
+        sys.exit(0 if result["completed"] == 1 and not result["read_errors"] else 1)
+    elif args.command == "cache":
+        emit(asyncio.run(cache_test(args)), args)
+    elif args.command == "extract":
+        result = asyncio.run(extract_test(args))
+        emit(result, args)
+        sys.exit(0 if result["ok"] else 1)
+
+
+if __name__ == "__main__":
+    main()
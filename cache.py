@@ -0,0 +1,229 @@
+# cache.py
+
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlparse
+
+YOUTUBE_ID = re.compile(r"(?:v=|youtu\.be/|/shorts/|/embed/|/live/)([\w-]{11})")
+PATH_EXPIRE = re.compile(r"/expire/(\d+)")
+
+
+def stream_expiry(url):
+    # googlevideo URLs carry their expiry as a unix timestamp, either as ?expire= or /expire/<ts>/.
+    if not url:
+        return None
+    parsed = urlparse(url)
+    value = parse_qs(parsed.query).get("expire", [None])[0]
+    if value is None:
+        match = PATH_EXPIRE.search(parsed.path)
+        value = match.group(1) if match else None
+    return float(value) if value and value.isdigit() else None
+
+
+def cache_key(query):
+    # Video URLs are keyed by their canonical id so every spelling of a link shares one entry.
+    query = query.strip()
+    match = YOUTUBE_ID.search(query) if "youtu" in query else None
+    if match:
+        return f"id:{match.group(1)}"
+    if "://" in query:
+        return f"q:{query}"
+    return f"q:{' '.join(query.lower().split())}"
+
+
+def _metadata(entry):
+    if entry.get("_type") == "url":
+        webpage_url = entry.get("webpage_url") or entry.get("url")
+    else:
+        webpage_url = entry.get("webpage_url") or entry.get("original_url")
+    return {
+        "id": entry.get("id"),
+        "title": entry.get("title"),
+        "duration": entry.get("duration"),
+        "thumbnail": entry.get("thumbnail"),
+        "webpage_url": webpage_url,
+        "acodec": entry.get("acodec"),
+        "asr": entry.get("asr"),
+    }
+
+
+def _entry(meta, stream_url):
+    # Rebuilds an extract_info-shaped dict: resolved when a live stream URL is known, flat otherwise.
+    if stream_url:
+        return {**meta, "url": stream_url}
+    return {**meta, "_type": "url", "url": meta["webpage_url"]}
+
+
+class ExtractionCache:
+    # Two tiers in front of extract_info: an in-memory LRU and an SQLite store.
+    # Track metadata is kept until evicted by the size cap; stream URLs only until
+    # their embedded expiry minus `url_margin` seconds.
+    def __init__(self, path, *, max_entries=50000, memory_entries=2048, url_margin=300, query_ttl=21600):
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.url_margin = url_margin
+        self.query_ttl = query_ttl
+        self.memory = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tracks (key TEXT PRIMARY KEY, meta TEXT, stream_url TEXT, expires REAL, accessed REAL)"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS queries (key TEXT PRIMARY KEY, ids TEXT, stored REAL, accessed REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS tracks_accessed ON tracks (accessed)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS queries_accessed ON queries (accessed)")
+
+    def stats(self):
+        with self._lock:
+            disk_entries = self._db.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_evictions": self.memory_evictions,
+            "disk_evictions": self.disk_evictions,
+            "memory_entries": len(self.memory),
+            "disk_entries": disk_entries,
+        }
+
+    def lookup(self, query):
+        # Returns the cached entries for a play query, or None on a miss.
+        key = cache_key(query)
+        with self._lock:
+            if key.startswith("id:"):
+                entries = self._entries([key[3:]])
+            else:
+                ids = self._query_ids(key)
+                entries = self._entries(ids) if ids is not None else None
+        if entries is None:
+            self.misses += 1
+        return entries
+
+    def stream(self, video_id):
+        # Returns a resolved entry only while its stream URL is still safely playable.
+        with self._lock:
+            entries = self._entries([video_id], require_stream=True) if video_id else None
+        if entries is None:
+            self.misses += 1
+            return None
+        return entries[0]
+
+    def store(self, query, data):
+        entries = data["entries"] if "entries" in data else [data]
+        entries = [entry for entry in entries if entry]
+        now = time.time()
+        with self._lock:
+            for entry in entries:
+                if entry.get("id"):
+                    self._put_track(entry, now)
+            key = cache_key(query)
+            ids = [entry.get("id") for entry in entries]
+            if key.startswith("q:") and ids and all(ids):
+                self._remember(key, (ids, now))
+                self._db.execute(
+                    "INSERT OR REPLACE INTO queries (key, ids, stored, accessed) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(ids), now, now),
+                )
+            self._writes += 1
+            if self._writes % 256 == 0:
+                self._evict_disk()
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+            self.memory_evictions += 1
+
+    def _query_ids(self, key):
+        now = time.time()
+        cached = self.memory.get(key)
+        if cached is None:
+            row = self._db.execute("SELECT ids, stored FROM queries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            cached = (json.loads(row[0]), row[1])
+            self._db.execute("UPDATE queries SET accessed = ? WHERE key = ?", (now, key))
+        ids, stored = cached
+        if now - stored > self.query_ttl:
+            self.memory.pop(key, None)
+            return None
+        self._remember(key, cached)
+        return ids
+
+    def _track(self, video_id):
+        key = f"id:{video_id}"
+        cached = self.memory.get(key)
+        if cached is not None:
+            self.memory.move_to_end(key)
+            return cached, True
+        row = self._db.execute("SELECT meta, stream_url, expires FROM tracks WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None, False
+        cached = (json.loads(row[0]), row[1], row[2])
+        self._db.execute("UPDATE tracks SET accessed = ? WHERE key = ?", (time.time(), key))
+        self._remember(key, cached)
+        return cached, False
+
+    def _entries(self, ids, require_stream=False):
+        deadline = time.time() + self.url_margin
+        entries = []
+        from_memory = True
+        for video_id in ids:
+            cached, in_memory = self._track(video_id)
+            if cached is None:
+                return None
+            meta, stream_url, expires = cached
+            if expires is None or expires < deadline:
+                stream_url = None
+            if require_stream and stream_url is None:
+                return None
+            from_memory = from_memory and in_memory
+            entries.append(_entry(meta, stream_url))
+        if from_memory:
+            self.memory_hits += 1
+        else:
+            self.disk_hits += 1
+        return entries
+
+    def _put_track(self, entry, now):
+        key = f"id:{entry['id']}"
+        meta = _metadata(entry)
+        previous, _ = self._track(entry["id"])
+        stream_url = entry.get("url") if entry.get("_type") != "url" else None
+        expires = stream_expiry(stream_url)
+        if previous is not None:
+            meta = {**previous[0], **{k: v for k, v in meta.items() if v is not None}}
+            if expires is None:
+                stream_url, expires = previous[1], previous[2]
+        if expires is None:
+            # Without a known expiry a stream URL can't be trusted later; keep the metadata only.
+            stream_url = None
+        self._remember(key, (meta, stream_url, expires))
+        self._db.execute(
+            "INSERT OR REPLACE INTO tracks (key, meta, stream_url, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+            (key, json.dumps(meta), stream_url, expires, now),
+        )
+
+    def _evict_disk(self):
+        for table in ("tracks", "queries"):
+            excess = self._db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._db.execute(
+                    f"DELETE FROM {table} WHERE key IN (SELECT key FROM {table} ORDER BY accessed LIMIT ?)", (excess,)
+                )
+                self.disk_evictions += excess
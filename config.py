@@ -10,3 +10,100 @@ BOT_OWNER_ID = int(os.environ.get("BOT_OWNER_ID", "Bot Owner ID")) # Replace wit
 
 # You can change the bot's command prefix here
 COMMAND_PREFIX = "?"
+
+# How many upcoming queue entries get their stream resolved ahead of time.
+# Each prefetched entry holds one ffmpeg process, so this also bounds them per guild.
+PLAYLIST_LOOKAHEAD = int(os.environ.get("PLAYLIST_LOOKAHEAD", "2"))
+
+# Extraction cache: metadata is kept until evicted by the size cap, stream URLs
+# only until their embedded expiry minus the safety margin (seconds).
+CACHE_PATH = os.environ.get("CACHE_PATH", "extraction_cache.sqlite3")
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "50000"))
+CACHE_MEMORY_ENTRIES = int(os.environ.get("CACHE_MEMORY_ENTRIES", "2048"))
+CACHE_QUERY_TTL = int(os.environ.get("CACHE_QUERY_TTL", "21600"))
+STREAM_URL_MARGIN = int(os.environ.get("STREAM_URL_MARGIN", "300"))
+
+# Extraction worker pool: each worker process owns its own YoutubeDL instance.
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", "2"))
+EXTRACT_CONCURRENCY = int(os.environ.get("EXTRACT_CONCURRENCY", "0")) or EXTRACT_WORKERS
+
+# Extraction admission control: token buckets on extraction starts (per second,
+# with burst), globally and per guild, and caps on queued lookups beyond which
+# ?play answers "busy". 0 disables a limit.
+EXTRACT_RATE = float(os.environ.get("EXTRACT_RATE", "5"))
+EXTRACT_BURST = int(os.environ.get("EXTRACT_BURST", "10"))
+EXTRACT_GUILD_RATE = float(os.environ.get("EXTRACT_GUILD_RATE", "1"))
+EXTRACT_GUILD_BURST = int(os.environ.get("EXTRACT_GUILD_BURST", "5"))
+EXTRACT_QUEUE_LIMIT = int(os.environ.get("EXTRACT_QUEUE_LIMIT", "200"))
+EXTRACT_GUILD_QUEUE_LIMIT = int(os.environ.get("EXTRACT_GUILD_QUEUE_LIMIT", "10"))
+
+# "pcm" decodes through ffmpeg and scales volume in Python; "opus" hands Opus
+# packets straight to Discord, copying the stream when the source is already Opus.
+PLAYBACK_MODE = os.environ.get("PLAYBACK_MODE", "pcm")
+
+# Audio worker processes that decode, apply volume and Opus-encode off the gateway
+# process. 0 keeps playback in-process (PLAYBACK_MODE applies); set it to roughly
+# the number of spare cores when running many concurrent guilds.
+AUDIO_WORKERS = int(os.environ.get("AUDIO_WORKERS", "0"))
+
+# PCM mode: seconds before the end of a track to pre-spawn and pre-buffer the
+# next one, optional crossfade length, and how long volume changes ramp for.
+GAPLESS_PRELOAD = float(os.environ.get("GAPLESS_PRELOAD", "5"))
+CROSSFADE = float(os.environ.get("CROSSFADE", "0"))
+VOLUME_RAMP = float(os.environ.get("VOLUME_RAMP", "0.2"))
+
+# When a stream stops early (an expired or dropped URL) the track is re-resolved and
+# resumed where it stopped, up to RECOVERY_ATTEMPTS times per track. Silence plays
+# for at most RECOVERY_TIMEOUT seconds meanwhile, and in PCM mode the replacement
+# buffers RECOVERY_PREBUFFER seconds before it takes over. The cut itself is only
+# noticed once the stream runs dry, so that silence is not covered from a buffer.
+# Tracks without a known duration (live streams) end when their stream does.
+RECOVERY_ATTEMPTS = int(os.environ.get("RECOVERY_ATTEMPTS", "5"))
+RECOVERY_TIMEOUT = float(os.environ.get("RECOVERY_TIMEOUT", "15"))
+RECOVERY_PREBUFFER = float(os.environ.get("RECOVERY_PREBUFFER", "1"))
+
+# YouTube Data API search results are cached per normalized query.
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", "3600"))
+SEARCH_CACHE_ENTRIES = int(os.environ.get("SEARCH_CACHE_ENTRIES", "1024"))
+
+# Prometheus text metrics on http://METRICS_HOST:METRICS_PORT/metrics; 0 disables it.
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+
+# Player snapshots: queues, the current track and its offset are saved every
+# SNAPSHOT_INTERVAL seconds and restored after a restart. With RESUME_PLAYBACK the
+# bot rejoins the voice channels that were playing and seeks back to where it was.
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", "player_snapshots.sqlite3")
+SNAPSHOT_INTERVAL = float(os.environ.get("SNAPSHOT_INTERVAL", "10"))
+RESUME_PLAYBACK = os.environ.get("RESUME_PLAYBACK", "1") == "1"
+
+# Janitor: every JANITOR_INTERVAL seconds it disconnects voice clients idle or alone
+# for VOICE_IDLE_TIMEOUT, drops guild state unused for PLAYER_STATE_TTL (and the
+# least recently used beyond MAX_PLAYERS; queues stay in the snapshot store),
+# forgets ?search results after SEARCH_RESULTS_TTL and reaps orphaned ffmpeg processes.
+JANITOR_INTERVAL = float(os.environ.get("JANITOR_INTERVAL", "60"))
+VOICE_IDLE_TIMEOUT = float(os.environ.get("VOICE_IDLE_TIMEOUT", "300"))
+PLAYER_STATE_TTL = float(os.environ.get("PLAYER_STATE_TTL", "3600"))
+MAX_PLAYERS = int(os.environ.get("MAX_PLAYERS", "500"))
+SEARCH_RESULTS_TTL = float(os.environ.get("SEARCH_RESULTS_TTL", "600"))
+
+# Outbound updates: the bot's presence changes at most once per PRESENCE_INTERVAL
+# seconds whatever the number of playing guilds. ?nowplaying messages are edited in
+# place as tracks change and refreshed every NOWPLAYING_REFRESH seconds. Each guild
+# may edit MESSAGE_EDIT_RATE times per second (MESSAGE_EDIT_BURST at once), and edits
+# across all guilds are capped at MESSAGE_EDIT_GLOBAL_RATE per second.
+PRESENCE_INTERVAL = float(os.environ.get("PRESENCE_INTERVAL", "15"))
+NOWPLAYING_REFRESH = float(os.environ.get("NOWPLAYING_REFRESH", "15"))
+MESSAGE_EDIT_RATE = float(os.environ.get("MESSAGE_EDIT_RATE", "1"))
+MESSAGE_EDIT_BURST = int(os.environ.get("MESSAGE_EDIT_BURST", "5"))
+MESSAGE_EDIT_GLOBAL_RATE = float(os.environ.get("MESSAGE_EDIT_GLOBAL_RATE", "20"))
+
+# On-disk audio cache: tracks played AUDIO_CACHE_MIN_PLAYS times are downloaded as
+# Opus into AUDIO_CACHE_DIR and played from there, least recently played evicted
+# beyond AUDIO_CACHE_SIZE_MB. Tracks longer than AUDIO_CACHE_MAX_DURATION seconds
+# (and live streams) always stream. 0 MB disables the cache.
+AUDIO_CACHE_DIR = os.environ.get("AUDIO_CACHE_DIR", "audio_cache")
+AUDIO_CACHE_SIZE_MB = int(os.environ.get("AUDIO_CACHE_SIZE_MB", "0"))
+AUDIO_CACHE_MIN_PLAYS = int(os.environ.get("AUDIO_CACHE_MIN_PLAYS", "3"))
+AUDIO_CACHE_MAX_DURATION = int(os.environ.get("AUDIO_CACHE_MAX_DURATION", "1200"))
+AUDIO_CACHE_DOWNLOADS = int(os.environ.get("AUDIO_CACHE_DOWNLOADS", "1"))
@@ -0,0 +1,328 @@
+# extraction.py
+
+import asyncio
+import logging
+import multiprocessing
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+from cache import cache_key
+from ratelimit import TokenBucket
+
+log = logging.getLogger(__name__)
+
+# Each worker process owns one YoutubeDL instance, so parsing never contends
+# with the voice send threads for the gateway process' GIL.
+_ytdl = None
+
+# The fields Track and the extraction cache read. Everything else (formats,
+# thumbnails, captions, ...) is dropped in the worker, before it is pickled back.
+TRACK_FIELDS = ("_type", "id", "title", "duration", "thumbnail", "webpage_url", "original_url", "url", "acodec", "asr")
+
+
+def _init_worker(options):
+    global _ytdl
+    import yt_dlp
+    _ytdl = yt_dlp.YoutubeDL(options)
+
+
+def _warm_up():
+    return _ytdl is not None
+
+
+def slim(info):
+    data = {key: info[key] for key in TRACK_FIELDS if info.get(key) is not None}
+    if info.get("entries") is not None:
+        data["entries"] = [slim(entry) if entry else None for entry in info["entries"]]
+    return data
+
+
+def _extract(url):
+    started = time.perf_counter()
+    try:
+        info = _ytdl.extract_info(url, download=False)
+    except Exception as e:
+        # yt-dlp's errors keep references (its logger) that can't be pickled back.
+        raise RuntimeError(str(e)) from None
+    data = slim(info)
+    return data, time.perf_counter() - started
+
+
+class ExtractionBusy(Exception):
+    def __init__(self, scope):
+        super().__init__(
+            "Too many songs are being looked up right now, try again in a few seconds."
+            if scope == "global" else "This server has too many songs being looked up, try again in a few seconds."
+        )
+        self.scope = scope
+
+
+class ExtractionJob:
+    # One extract_info call, shared by every request for the same canonical URL or
+    # query that arrives while it is queued or running. Each requester gets its own
+    # future, so cancelling one guild's requests never fails another's.
+    def __init__(self, url, key, guild_id, on_result=None):
+        self.url = url
+        self.key = key
+        self.guild_id = guild_id
+        self.on_result = on_result
+        self.waiters = []
+        self.queued = time.perf_counter()
+        self.started = None
+
+    def wait(self, guild_id):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((guild_id, future))
+        return future
+
+    @property
+    def abandoned(self):
+        return all(future.done() for _, future in self.waiters)
+
+    def cancel(self, guild_id):
+        count = 0
+        for waiter_guild, future in self.waiters:
+            if waiter_guild == guild_id and future.cancel():
+                count += 1
+        return count
+
+    def resolve(self, data=None, error=None):
+        for _, future in self.waiters:
+            if not future.done():
+                if error is None:
+                    future.set_result(data)
+                else:
+                    future.set_exception(error)
+
+
+class ExtractionEngine:
+    # Runs extract_info on a process pool. Pending jobs are queued per guild and
+    # dispatched round-robin, so one guild enqueueing a huge playlist can't starve others.
+    # Concurrent requests for the same URL share one job (single flight). Starts are
+    # rate limited by global and per-guild token buckets, and new lookups are refused
+    # with ExtractionBusy once the wait queue is full instead of piling up.
+    def __init__(self, options, *, workers=2, concurrency=None, rate=0, burst=1, guild_rate=0, guild_burst=1,
+                 queue_limit=0, guild_queue_limit=0):
+        self.options = options
+        self.workers = workers
+        self.concurrency = concurrency or workers
+        self.queue_limit = queue_limit
+        self.guild_queue_limit = guild_queue_limit
+        self.guild_rate = guild_rate
+        self.guild_burst = guild_burst
+        self.bucket = TokenBucket(rate, burst)
+        self.guild_buckets = {}
+        self.pending = OrderedDict()
+        self.inflight = {}
+        self.running = set()
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.throttled = 0
+        self.wait_time = 0.0
+        self.extract_time = 0.0
+        self._pool = None
+        self._respawn = False
+        self._wakeup = None
+
+    def start(self):
+        # Worker processes are forked up front, before any voice threads exist. A pool
+        # replaced after a worker died is spawned instead: forking the running bot could
+        # copy a lock another thread holds into the children.
+        if self._pool is None:
+            fork = not self._respawn and "fork" in multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("fork" if fork else "spawn")
+            self._pool = ProcessPoolExecutor(
+                self.workers, mp_context=context, initializer=_init_worker, initargs=(self.options,)
+            )
+            for _ in range(self.workers):
+                self._pool.submit(_warm_up)
+        return self._pool
+
+    def shutdown(self):
+        for jobs in self.pending.values():
+            for job in jobs:
+                for _, future in job.waiters:
+                    future.cancel()
+        for job in self.running:
+            for _, future in job.waiters:
+                future.cancel()
+        self.pending.clear()
+        self.inflight.clear()
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def extract(self, url, *, guild_id=None, admission=True, on_result=None):
+        # `admission=False` skips the queue limits, for tracks that are already queued and
+        # only need their stream resolved. `on_result(data)` runs once per extraction, not
+        # once per coalesced request.
+        key = cache_key(url)
+        job = self.inflight.get(key)
+        if job is not None and not job.abandoned:
+            self.coalesced += 1
+            metrics.EXTRACT_COALESCED.inc()
+            return await job.wait(guild_id)
+        if admission:
+            self._admit(guild_id)
+        job = self.inflight[key] = ExtractionJob(url, key, guild_id, on_result)
+        future = job.wait(guild_id)
+        self.pending.setdefault(guild_id, deque()).append(job)
+        self._dispatch()
+        return await future
+
+    def _admit(self, guild_id):
+        scope = None
+        if self.queue_limit and self.queued >= self.queue_limit:
+            scope = "global"
+        elif self.guild_queue_limit and len(self.pending.get(guild_id, ())) >= self.guild_queue_limit:
+            scope = "guild"
+        if scope is not None:
+            self.rejected += 1
+            metrics.EXTRACT_REJECTED.inc(scope)
+            raise ExtractionBusy(scope)
+
+    @property
+    def queued(self):
+        return sum(len(jobs) for jobs in self.pending.values())
+
+    def cancel(self, guild_id):
+        # Cancels a guild's outstanding requests. Jobs nobody else is waiting on are
+        # dropped from the queue, or detached if a worker is already parsing them.
+        count = 0
+        for jobs in self.pending.values():
+            for job in jobs:
+                count += job.cancel(guild_id)
+        for job in self.running:
+            count += job.cancel(guild_id)
+        self.cancelled += count
+        return count
+
+    def stats(self):
+        finished = self.completed + self.failed
+        return {
+            "workers": self.workers,
+            "running": len(self.running),
+            "queued": self.queued,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+            "throttled": self.throttled,
+            "avg_wait": self.wait_time / finished if finished else 0.0,
+            "avg_extract": self.extract_time / finished if finished else 0.0,
+        }
+
+    def _broken(self, pool):
+        # A worker died; the next dispatch starts a replacement. Every job still on the
+        # broken pool fails with it, but only the first one drops it.
+        if self._pool is pool:
+            self._pool = None
+            self._respawn = True
+
+    def _forget(self, job):
+        if self.inflight.get(job.key) is job:
+            del self.inflight[job.key]
+
+    def _guild_bucket(self, guild_id):
+        bucket = self.guild_buckets.get(guild_id)
+        if bucket is None:
+            bucket = self.guild_buckets[guild_id] = TokenBucket(self.guild_rate, self.guild_burst)
+        return bucket
+
+    def _next_job(self):
+        # Returns (job, None), or (None, seconds until a throttled guild may start one).
+        now = time.monotonic()
+        delay = None
+        for guild_id in list(self.pending):
+            jobs = self.pending[guild_id]
+            while jobs and jobs[0].abandoned:
+                self._forget(jobs.popleft())
+            if not jobs:
+                del self.pending[guild_id]
+                continue
+            bucket = self._guild_bucket(guild_id)
+            wait = bucket.delay(now)
+            if wait:
+                delay = wait if delay is None else min(delay, wait)
+                continue
+            bucket.take()
+            job = jobs.popleft()
+            del self.pending[guild_id]
+            if jobs:
+                # Rotate the guild to the back so the next pick comes from someone else.
+                self.pending[guild_id] = jobs
+            return job, None
+        return None, delay
+
+    def _wake(self):
+        self._wakeup = None
+        self._dispatch()
+
+    def _schedule(self, delay):
+        if self._wakeup is None:
+            self.throttled += 1
+            self._wakeup = asyncio.get_running_loop().call_later(delay, self._wake)
+
+    def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while len(self.running) < self.concurrency and self.pending:
+            delay = self.bucket.delay(time.monotonic())
+            if delay:
+                return self._schedule(delay)
+            job, delay = self._next_job()
+            if job is None:
+                if delay:
+                    self._schedule(delay)
+                return
+            self.bucket.take()
+            job.started = time.perf_counter()
+            self.running.add(job)
+            pool = self.start()
+            try:
+                pool_future = loop.run_in_executor(pool, _extract, job.url)
+            except BrokenProcessPool:
+                self._broken(pool)
+                pool = self.start()
+                pool_future = loop.run_in_executor(pool, _extract, job.url)
+            pool_future.add_done_callback(lambda f, job=job, pool=pool: self._finished(job, pool, f))
+
+    def _finished(self, job, pool, pool_future):
+        self.running.discard(job)
+        self._forget(job)
+        wait = job.started - job.queued
+        extract_time = time.perf_counter() - job.started
+        data = None
+        # shutdown(cancel_futures=True) cancels queued pool futures.
+        error = asyncio.CancelledError() if pool_future.cancelled() else pool_future.exception()
+        if isinstance(error, BrokenProcessPool):
+            self._broken(pool)
+        if error is None:
+            data, extract_time = pool_future.result()
+            self.completed += 1
+        else:
+            self.failed += 1
+        self.wait_time += wait
+        self.extract_time += extract_time
+        metrics.EXTRACT_WAIT_SECONDS.observe(wait)
+        metrics.EXTRACT_SECONDS.observe(extract_time)
+        log.info("extraction guild=%s wait=%.3fs extract=%.3fs ok=%s url=%s", job.guild_id, wait, extract_time, error is None, job.url)
+        if error is None and job.on_result is not None:
+            try:
+                job.on_result(data)
+            except Exception:
+                log.exception("extraction result handler failed for %s", job.url)
+        job.resolve(data, error)
+        for guild_id in [guild_id for guild_id, bucket in self.guild_buckets.items() if bucket.full]:
+            if guild_id not in self.pending:
+                del self.guild_buckets[guild_id]
+        self._dispatch()
@@ -0,0 +1,167 @@
+# janitor.py
+
+import asyncio
+import logging
+import os
+import signal
+import time
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+RECLAIM_KINDS = ("voice_clients", "players", "search_results", "search_cache", "ffmpeg_processes")
+
+
+def _source_pids(source):
+    # ffmpeg processes behind a source and anything chained after it.
+    pids = set()
+    while source is not None:
+        process = getattr(getattr(source, "original", None), "_process", None)
+        if process is not None:
+            pids.add(process.pid)
+        source = getattr(source, "next", None)
+    return pids
+
+
+class Janitor:
+    # Periodically reclaims what long uptimes accumulate:
+    # - voice clients idle or alone in their channel past `idle_timeout`;
+    # - guild players unused for `state_ttl`, or the least recently used beyond
+    #   `max_players`. Their queues are flushed to the snapshot store and reloaded
+    #   from it the next time the guild plays;
+    # - ?search results older than `search_ttl`, and expired search cache entries;
+    # - ffmpeg children no live source owns, seen on two sweeps in a row.
+    def __init__(self, cog, *, snapshots, search, interval=60, idle_timeout=300, state_ttl=3600, max_players=500,
+                 search_ttl=600):
+        self.cog = cog
+        self.snapshots = snapshots
+        self.search = search
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.state_ttl = state_ttl
+        self.max_players = max_players
+        self.search_ttl = search_ttl
+        self.idle_since = {}
+        self.suspects = set()
+        self.sweeps = 0
+        self.reclaimed = dict.fromkeys(RECLAIM_KINDS, 0)
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception:
+                log.exception("janitor sweep failed")
+
+    async def sweep(self):
+        now = time.monotonic()
+        report = {
+            "voice_clients": await self._disconnect_idle(now),
+            "players": await self._evict_players(now),
+            "search_results": self._expire_search_results(now),
+            "search_cache": self.search.expire(),
+            "ffmpeg_processes": self._reap_ffmpeg(),
+        }
+        self.sweeps += 1
+        for kind, count in report.items():
+            self.reclaimed[kind] += count
+            if count:
+                metrics.JANITOR_RECLAIMED.inc(kind, amount=count)
+        if any(report.values()):
+            log.info("janitor reclaimed %s", ", ".join(f"{count} {kind.replace('_', ' ')}" for kind, count in report.items() if count))
+        else:
+            log.debug("janitor sweep reclaimed nothing")
+        return report
+
+    def stats(self):
+        return {"sweeps": self.sweeps, **self.reclaimed}
+
+    async def _disconnect_idle(self, now):
+        count = 0
+        connected = set()
+        for voice_client in list(self.cog.bot.voice_clients):
+            guild = voice_client.guild
+            connected.add(guild.id)
+            channel = voice_client.channel
+            alone = channel is not None and all(member.bot for member in channel.members)
+            if (voice_client.is_playing() or voice_client.is_paused()) and not alone:
+                self.idle_since.pop(guild.id, None)
+                continue
+            since = self.idle_since.setdefault(guild.id, now)
+            if now - since < self.idle_timeout:
+                continue
+            self.idle_since.pop(guild.id, None)
+            self.cog.release(guild.id)
+            try:
+                await voice_client.disconnect()
+                count += 1
+            except Exception as e:
+                log.warning("could not disconnect from %s: %s", guild.id, e)
+        for guild_id in set(self.idle_since) - connected:
+            del self.idle_since[guild_id]
+        return count
+
+    async def _evict_players(self, now):
+        players = self.cog.players
+        idle = sorted(
+            (player for player in players.values() if player.voice_client is None),
+            key=lambda player: player.last_active,
+        )
+        excess = len(players) - self.max_players
+        evicted = {}
+        for player in idle:
+            if now - player.last_active > self.state_ttl or len(evicted) < excess:
+                evicted[player.guild.id] = player
+        if not evicted:
+            return 0
+        last_active = {guild_id: player.last_active for guild_id, player in evicted.items()}
+        for player in evicted.values():
+            player.release()
+        # Queues survive eviction on disk; create_player restores them on next use.
+        await self.snapshots.flush(evicted)
+        count = 0
+        for guild_id, player in evicted.items():
+            if players.get(guild_id) is not player or player.last_active != last_active[guild_id]:
+                # Used again while the snapshot was being written.
+                continue
+            del players[guild_id]
+            self.snapshots.forget(guild_id)
+            self.cog.updates.forget(guild_id)
+            self.cog.search_results.pop(guild_id, None)
+            count += 1
+        return count
+
+    def _expire_search_results(self, now):
+        results = self.cog.search_results
+        expired = [guild_id for guild_id, (_, stored) in results.items() if now - stored > self.search_ttl]
+        for guild_id in expired:
+            del results[guild_id]
+        return len(expired)
+
+    def _reap_ffmpeg(self):
+        owned = set()
+        for player in self.cog.players.values():
+            for source in player.sources():
+                owned |= _source_pids(source)
+        orphans = metrics.ffmpeg_pids() - owned
+        # A source may still be under construction on one sweep; only reap on the second.
+        confirmed, self.suspects = orphans & self.suspects, orphans - self.suspects
+        for pid in confirmed:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, os.WNOHANG)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        return len(confirmed)
@@ -0,0 +1,201 @@
+# metrics.py
+
+import asyncio
+import bisect
+import os
+import threading
+
+# Everything below checks this flag first, so instrumentation costs one attribute
+# lookup when the endpoint is disabled.
+enabled = False
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+JITTER_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25)
+
+_registry = []
+_background = set()
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        if not enabled:
+            return
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in list(self.values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class Gauge:
+    # Gauges are read at scrape time from a callback returning either a number or
+    # a {labels tuple: value} dict, so nothing is maintained on the hot path.
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.function = None
+        _registry.append(self)
+
+    def set_function(self, function):
+        self.function = function
+
+    def render(self):
+        if self.function is None:
+            return
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.labelnames = labelnames
+        self.series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        if not enabled:
+            return
+        with self._lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total) in list(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', bound)])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+
+EXTRACT_SECONDS = Histogram("musicbot_extract_seconds", "Time spent in extract_info per job.")
+EXTRACT_WAIT_SECONDS = Histogram("musicbot_extract_wait_seconds", "Time extraction jobs waited for a worker.")
+FIRST_AUDIO_SECONDS = Histogram("musicbot_first_audio_seconds", "Time from ?play to the first audio frame.")
+FRAME_JITTER_SECONDS = Histogram(
+    "musicbot_frame_jitter_seconds", "Deviation of frame reads from the 20 ms schedule.", JITTER_BUCKETS
+)
+LOOP_LAG_SECONDS = Histogram("musicbot_event_loop_lag_seconds", "How late the event loop ran a scheduled wakeup.", JITTER_BUCKETS)
+EXTRACT_COALESCED = Counter("musicbot_extract_coalesced_total", "Requests that joined an extraction already in flight.")
+EXTRACT_REJECTED = Counter("musicbot_extract_rejected_total", "Lookups refused because the wait queue was full.", labelnames=("scope",))
+COMMAND_SECONDS = Histogram("musicbot_command_seconds", "Command handling latency.", labelnames=("command",))
+COMMAND_ERRORS = Counter("musicbot_command_errors_total", "Commands that raised.", labelnames=("command", "error"))
+QUEUE_DEPTH = Gauge("musicbot_queue_depth", "Entries waiting in each guild's queue.", labelnames=("guild",))
+AUDIO_WORKER_STREAMS = Gauge("musicbot_audio_worker_streams", "Streams assigned to each audio worker process.", labelnames=("worker",))
+STREAM_RECOVERIES = Counter("musicbot_stream_recoveries_total", "Streams that ended early and were resumed, by outcome.", labelnames=("outcome",))
+STREAM_RECOVERY_SECONDS = Histogram("musicbot_stream_recovery_seconds", "Time from a stream dropping to its replacement playing.")
+JANITOR_RECLAIMED = Counter("musicbot_janitor_reclaimed_total", "Resources reclaimed by the janitor.", labelnames=("kind",))
+FFMPEG_PROCESSES = Gauge("musicbot_ffmpeg_processes", "Live ffmpeg subprocesses.")
+
+
+def ffmpeg_processes():
+    # Audio workers run their own ffmpeg children, so the gauge counts the whole tree.
+    return len(ffmpeg_pids(nested=True))
+
+
+def _process_table():
+    # pid -> (command name, parent pid), straight from /proc; empty where it is unavailable.
+    table = {}
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return table
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                raw = f.read()
+        except OSError:
+            continue
+        table[int(entry)] = (raw[raw.index("(") + 1:raw.rindex(")")], int(raw[raw.rindex(")") + 2:].split()[1]))
+    return table
+
+
+def ffmpeg_pids(nested=False):
+    # Our ffmpeg children; with `nested`, also those of our descendants (audio workers).
+    table = _process_table()
+    parents = frontier = {os.getpid()}
+    while nested and frontier:
+        frontier = {pid for pid, (_, ppid) in table.items() if ppid in frontier} - parents
+        parents = parents | frontier
+    return {pid for pid, (name, ppid) in table.items() if name == "ffmpeg" and ppid in parents}
+
+
+FFMPEG_PROCESSES.set_function(ffmpeg_processes)
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def _handle(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        if request.split(b" ")[1:2] == [b"/metrics"]:
+            body = render().encode()
+            status = b"200 OK"
+        else:
+            body, status = b"not found\n", b"404 Not Found"
+        writer.write(
+            b"HTTP/1.1 " + status + b"\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def _watch_loop_lag(interval=0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        scheduled = loop.time() + interval
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - scheduled))
+
+
+async def start(host, port):
+    global enabled
+    enabled = True
+    server = await asyncio.start_server(_handle, host, port)
+    task = asyncio.get_running_loop().create_task(_watch_loop_lag())
+    _background.add(task)
+    print(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+    return server
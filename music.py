@@ -2,11 +2,22 @@
 
 import discord
 from discord.ext import commands
-import asyncio
-import yt_dlp
+import functools
+import time
 import logging
-from googleapiclient.discovery import build
 import config
+import metrics
+from tracks import Track
+from cache import ExtractionCache
+from extraction import ExtractionBusy, ExtractionEngine
+from audio import MixingSource, OpusSource
+from search import YouTubeSearch
+from player import GuildPlayer, LOOP_MODES
+from workers import AudioWorkerPool
+from snapshots import SnapshotStore
+from janitor import Janitor
+from updates import UpdateScheduler
+from audiocache import AudioCache
 
 # --- YTDL Options ---
 ytdl_format_options = {
@@ -20,6 +31,7 @@ ytdl_format_options = {
     "quiet": True,
     "no_warnings": True,
     "default_search": "ytsearch",
+    "extract_flat": "in_playlist",
     "source_address": "0.0.0.0",
     "cookiefile": "youtube_cookie.txt" if __import__('os').path.exists("youtube_cookie.txt") else None,
     "postprocessors": [{"key": "FFmpegExtractAudio", "preferredcodec": "mp3", "preferredquality": "320"}],
@@ -31,41 +43,195 @@ ffmpeg_options = {
     "options": "-vn -ac 2 -ar 48000 -b:a 320k -probesize 32 -analyzeduration 0 -nostats -loglevel quiet",
 }
 
-ytdl = yt_dlp.YoutubeDL(ytdl_format_options)
+extraction_engine = ExtractionEngine(
+    ytdl_format_options,
+    workers=config.EXTRACT_WORKERS,
+    concurrency=config.EXTRACT_CONCURRENCY,
+    rate=config.EXTRACT_RATE,
+    burst=config.EXTRACT_BURST,
+    guild_rate=config.EXTRACT_GUILD_RATE,
+    guild_burst=config.EXTRACT_GUILD_BURST,
+    queue_limit=config.EXTRACT_QUEUE_LIMIT,
+    guild_queue_limit=config.EXTRACT_GUILD_QUEUE_LIMIT,
+)
 
-class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=0.5):
-        super().__init__(source, volume)
-        self.data = data
-        self.title = data.get("title")
-        self.url = data.get("url")
-        self.duration = data.get("duration")
-        self.thumbnail = data.get("thumbnail")
+extraction_cache = ExtractionCache(
+    config.CACHE_PATH,
+    max_entries=config.CACHE_MAX_ENTRIES,
+    memory_entries=config.CACHE_MEMORY_ENTRIES,
+    url_margin=config.STREAM_URL_MARGIN,
+    query_ttl=config.CACHE_QUERY_TTL,
+)
 
+audio_workers = AudioWorkerPool(config.AUDIO_WORKERS)
+
+snapshot_store = SnapshotStore(config.SNAPSHOT_PATH, interval=config.SNAPSHOT_INTERVAL)
+
+audio_cache = AudioCache(
+    config.AUDIO_CACHE_DIR,
+    ytdl_format_options,
+    max_bytes=config.AUDIO_CACHE_SIZE_MB * 2**20,
+    min_plays=config.AUDIO_CACHE_MIN_PLAYS,
+    max_duration=config.AUDIO_CACHE_MAX_DURATION,
+    downloads=config.AUDIO_CACHE_DOWNLOADS,
+)
+
+QUEUE_PAGE_SIZE = 10
+
+youtube_search = YouTubeSearch(
+    config.YOUTUBE_API_KEY,
+    ttl=config.SEARCH_CACHE_TTL,
+    max_entries=config.SEARCH_CACHE_ENTRIES,
+)
+
+class YTDLSource(MixingSource):
     @classmethod
-    async def from_url(cls, url, *, loop=None, stream=True):
-        loop = loop or asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=not stream))
-        if "entries" in data:
-            return [cls(discord.FFmpegPCMAudio(entry["url"], **ffmpeg_options), data=entry) for entry in data["entries"]]
-        else:
-            return [cls(discord.FFmpegPCMAudio(data["url"], **ffmpeg_options), data=data)]
+    async def from_url(cls, url, *, guild_id=None):
+        # Playlists come back flat (id/title/duration only); streams are resolved per track later.
+        entries = extraction_cache.lookup(url)
+        if entries is None:
+            data = await extraction_engine.extract(
+                url, guild_id=guild_id, on_result=functools.partial(extraction_cache.store, url)
+            )
+            entries = data["entries"] if "entries" in data else [data]
+        return [Track(entry) for entry in entries if entry]
+
+    @classmethod
+    async def from_track(cls, track, *, guild_id=None, volume=None, offset=0.0, refresh=False):
+        # `refresh` re-extracts even if the cached stream URL looks valid, e.g. after it failed mid-track.
+        # Tracks in the audio cache play from their local file unless it has since been evicted.
+        path = None if refresh else audio_cache.lookup(track.id)
+        if path is not None:
+            track.update({"url": path, "acodec": "opus", "asr": 48000})
+        elif refresh or not track.resolved or audio_cache.owns(track.stream_url):
+            data = None if refresh else extraction_cache.stream(track.id)
+            if data is None:
+                data = await extraction_engine.extract(
+                    track.webpage_url, guild_id=guild_id, admission=False,
+                    on_result=functools.partial(extraction_cache.store, track.webpage_url),
+                )
+            track.update(data)
+        # Without an explicit volume each kind of source keeps its own default.
+        settings = {"offset": offset} if volume is None else {"offset": offset, "volume": volume}
+        # ffmpeg rejects the reconnect flags for local files.
+        before_options = "" if audio_cache.owns(track.stream_url) else ffmpeg_options["before_options"]
+        if config.AUDIO_WORKERS:
+            return audio_workers.open(
+                track, guild_id=guild_id, before_options=before_options, options=ffmpeg_options["options"], **settings,
+            )
+        if config.PLAYBACK_MODE == "opus":
+            return OpusSource(track, before_options=before_options, options=ffmpeg_options["options"], **settings)
+        if offset:
+            before_options = f"{before_options} -ss {offset:.2f}"
+        return cls(
+            discord.FFmpegPCMAudio(track.stream_url, before_options=before_options, options=ffmpeg_options["options"]),
+            track=track,
+            **settings,
+        )
 
 class MusicCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.song_queues = {}
+        self.players = {}
         self.search_results = {}
+        self.resumed = False
+        self.janitor = Janitor(
+            self,
+            snapshots=snapshot_store,
+            search=youtube_search,
+            interval=config.JANITOR_INTERVAL,
+            idle_timeout=config.VOICE_IDLE_TIMEOUT,
+            state_ttl=config.PLAYER_STATE_TTL,
+            max_players=config.MAX_PLAYERS,
+            search_ttl=config.SEARCH_RESULTS_TTL,
+        )
+        self.updates = UpdateScheduler(
+            bot,
+            presence_interval=config.PRESENCE_INTERVAL,
+            refresh=config.NOWPLAYING_REFRESH,
+            edit_rate=config.MESSAGE_EDIT_RATE,
+            edit_burst=config.MESSAGE_EDIT_BURST,
+            global_edit_rate=config.MESSAGE_EDIT_GLOBAL_RATE,
+        )
+        metrics.QUEUE_DEPTH.set_function(
+            lambda: {(str(guild_id),): len(player.queue) for guild_id, player in self.players.items()}
+        )
+
+    async def cog_load(self):
+        extraction_engine.start()
+        audio_cache.start()
+        if config.AUDIO_WORKERS:
+            audio_workers.start()
+        snapshot_store.start(self.players)
+        self.janitor.start()
+        self.updates.start()
+
+    async def cog_unload(self):
+        self.janitor.stop()
+        self.updates.stop()
+        await snapshot_store.stop(self.players)
+        extraction_engine.shutdown()
+        audio_cache.shutdown()
+        audio_workers.shutdown()
+
+    async def cog_before_invoke(self, ctx):
+        ctx.started_at = time.perf_counter()
+
+    async def cog_after_invoke(self, ctx):
+        metrics.COMMAND_SECONDS.observe(time.perf_counter() - ctx.started_at, ctx.command.name)
 
     @commands.Cog.listener()
     async def on_ready(self):
         print(f"Logged in as {self.bot.user} (ID: {self.bot.user.id})")
         print("------")
+        if config.RESUME_PLAYBACK and not self.resumed:
+            self.resumed = True
+            await self.resume_players()
+
+    async def resume_players(self):
+        # Rejoins the voice channels that were playing before the restart. Only the
+        # interrupted track (and the lookahead) is resolved; it seeks to its saved offset.
+        for guild_id, (state, _) in snapshot_store.load().items():
+            guild = self.bot.get_guild(guild_id)
+            voice_channel = guild.get_channel(state.get("voice_channel") or 0) if guild else None
+            if voice_channel is None or not state.get("current"):
+                continue
+            player = self.players.get(guild_id) or self.create_player(guild)
+            player.channel = guild.get_channel(state.get("channel") or 0)
+            try:
+                if guild.voice_client is None:
+                    await voice_channel.connect()
+                await player.play_next()
+            except Exception as e:
+                print(f"Could not resume playback in {guild.name}: {e}")
 
-    async def get_queue(self, ctx):
-        if ctx.guild.id not in self.song_queues:
-            self.song_queues[ctx.guild.id] = asyncio.Queue()
-        return self.song_queues[ctx.guild.id]
+    def create_player(self, guild):
+        player = self.players[guild.id] = GuildPlayer(
+            guild,
+            loop=self.bot.loop,
+            loader=functools.partial(YTDLSource.from_track, guild_id=guild.id),
+            on_start=self.track_started,
+            on_idle=self.player_idle,
+            on_error=self.track_failed,
+        )
+        # Restored lazily: a guild's queue is rebuilt the first time its player is needed.
+        snapshot = snapshot_store.load_guild(guild.id)
+        if snapshot is not None:
+            player.restore(*snapshot)
+        return player
+
+    def get_player(self, ctx):
+        player = self.players.get(ctx.guild.id) or self.create_player(ctx.guild)
+        player.channel = ctx.channel
+        player.last_active = time.monotonic()
+        return player
+
+    def release(self, guild_id):
+        # Stops work for a guild that is leaving voice; its queue is kept.
+        extraction_engine.cancel(guild_id)
+        if guild_id in self.players:
+            self.players[guild_id].release()
+        self.updates.refresh_message(guild_id)
 
     def create_embed(self, title, description, color=discord.Color.blurple()):
         return discord.Embed(title=title, description=description, color=color)
@@ -82,6 +248,7 @@ class MusicCog(commands.Cog):
 
     @commands.command(name="leave")
     async def leave(self, ctx):
+        self.release(ctx.guild.id)
         if ctx.voice_client:
             await ctx.voice_client.disconnect()
             await ctx.send(embed=self.create_embed("Left Channel", "Successfully disconnected from the voice channel."))
@@ -91,12 +258,10 @@ class MusicCog(commands.Cog):
         if not config.YOUTUBE_API_KEY:
             return await ctx.send(embed=self.create_embed("Error", "YouTube API key is not set.", discord.Color.red()))
         try:
-            youtube = build("youtube", "v3", developerKey=config.YOUTUBE_API_KEY)
-            search_response = youtube.search().list(q=query, part="snippet", maxResults=10, type="video").execute()
-            videos = [(item["snippet"]["title"], item["id"]["videoId"]) for item in search_response.get("items", [])]
+            videos = await youtube_search.search(query)
             if not videos:
                 return await ctx.send(embed=self.create_embed("No Results", "No songs found for your query.", discord.Color.orange()))
-            self.search_results[ctx.guild.id] = videos
+            self.search_results[ctx.guild.id] = (videos, time.monotonic())
             response = "\n".join(f"**{i+1}.** {title}" for i, (title, _) in enumerate(videos))
             await ctx.send(embed=self.create_embed("Search Results", response))
         except Exception as e:
@@ -104,85 +269,197 @@ class MusicCog(commands.Cog):
 
     @commands.command(name="play")
     async def play(self, ctx, *, query):
-        queue = await self.get_queue(ctx)
+        requested_at = time.perf_counter()
+        player = self.get_player(ctx)
         try:
             if query.isdigit() and ctx.guild.id in self.search_results:
-                video_id = self.search_results[ctx.guild.id][int(query) - 1][1]
+                video_id = self.search_results[ctx.guild.id][0][int(query) - 1][1]
                 url = f"https://www.youtube.com/watch?v={video_id}"
             else:
                 url = query
 
             async with ctx.typing():
-                players = await YTDLSource.from_url(url, loop=self.bot.loop)
-                for player in players:
-                    await queue.put(player)
+                tracks = await YTDLSource.from_url(url, guild_id=ctx.guild.id)
+                player.queue.extend(tracks)
                 
-                if len(players) > 1:
-                    await ctx.send(embed=self.create_embed("Playlist Added", f"Added {len(players)} songs to the queue."))
+                if len(tracks) > 1:
+                    await ctx.send(embed=self.create_embed("Playlist Added", f"Added {len(tracks)} songs to the queue."))
                 else:
-                    await ctx.send(embed=self.create_embed("Song Added", f"Added `{players[0].title}` to the queue."))
+                    await ctx.send(embed=self.create_embed("Song Added", f"Added `{tracks[0].title}` to the queue."))
 
             if not ctx.voice_client.is_playing():
-                await self.play_next(ctx)
+                await player.play_next(requested_at=requested_at)
+            else:
+                player.prefetch()
+        except ExtractionBusy as e:
+            await ctx.send(embed=self.create_embed("Busy", str(e), discord.Color.orange()))
         except Exception as e:
             await ctx.send(embed=self.create_embed("Error", f"An error occurred: {e}", discord.Color.red()))
 
-    async def play_next(self, ctx):
-        queue = await self.get_queue(ctx)
-        if not queue.empty() and ctx.voice_client:
-            player = await queue.get()
-            ctx.voice_client.play(player, after=lambda e: self.bot.loop.create_task(self.play_next(ctx)))
-            await self.nowplaying(ctx, silent=True)
+    async def track_started(self, player, source):
+        audio_cache.played(source.track)
+        self.updates.refresh_message(player.guild.id)
+
+    async def player_idle(self, player):
+        self.updates.refresh_message(player.guild.id)
+
+    async def track_failed(self, player, track, error):
+        if player.channel:
+            await player.channel.send(embed=self.create_embed("Error", f"Could not play `{track.title}`: {error}", discord.Color.red()))
 
     @commands.command(name="volume")
     async def volume(self, ctx, volume: int):
         if ctx.voice_client and ctx.voice_client.source:
             if 0 <= volume <= 200:
-                ctx.voice_client.source.volume = volume / 100
+                self.get_player(ctx).set_volume(volume / 100)
                 await ctx.send(embed=self.create_embed("Volume Control", f"Volume set to {volume}%"))
             else:
                 await ctx.send(embed=self.create_embed("Volume Error", "Volume must be between 0 and 200.", discord.Color.red()))
 
+    def nowplaying_embed(self, guild_id):
+        # Rendered whenever a live ?nowplaying message is due for an edit; None once the
+        # guild's player is gone, which stops the updates.
+        player = self.players.get(guild_id)
+        if player is None:
+            return None
+        source = player.source
+        if source is None:
+            return self.create_embed("Not Playing", "The bot is not currently playing anything.")
+        embed = self.create_embed("Now Playing", f"[{source.title}]({source.url})")
+        embed.set_thumbnail(url=source.thumbnail)
+        position = int(getattr(source, "position", 0))
+        duration = f"{position // 60}:{position % 60:02d}"
+        if source.duration:
+            duration += f" / {source.duration // 60}:{source.duration % 60:02d}"
+        embed.add_field(name="Duration", value=duration)
+        embed.add_field(name="Queue", value=f"{len(player.queue)} songs remaining")
+        return embed
+
     @commands.command(name="nowplaying")
-    async def nowplaying(self, ctx, silent=False):
-        if ctx.voice_client and ctx.voice_client.source:
-            player = ctx.voice_client.source
-            queue = await self.get_queue(ctx)
-            embed = self.create_embed("Now Playing", f"[{player.title}]({player.url})")
-            embed.set_thumbnail(url=player.thumbnail)
-            embed.add_field(name="Duration", value=f"{player.duration // 60}:{player.duration % 60:02d}")
-            embed.add_field(name="Queue", value=f"{queue.qsize()} songs remaining")
-            if not silent:
-                await ctx.send(embed=embed)
-        elif not silent:
-            await ctx.send(embed=self.create_embed("Not Playing", "The bot is not currently playing anything."))
+    async def nowplaying(self, ctx):
+        self.get_player(ctx)
+        embed = self.nowplaying_embed(ctx.guild.id)
+        message = await ctx.send(embed=embed)
+        # The message then follows track changes until a newer ?nowplaying replaces it.
+        self.updates.track_message(ctx.guild.id, message, functools.partial(self.nowplaying_embed, ctx.guild.id), embed)
 
     @commands.command(name="queue")
-    async def queue_info(self, ctx):
-        queue = await self.get_queue(ctx)
-        if not queue.empty():
-            queue_list = "\n".join(f"**{i+1}.** {player.title}" for i, player in enumerate(list(queue._queue)))
-            await ctx.send(embed=self.create_embed("Current Queue", queue_list))
+    async def queue_info(self, ctx, page: int = 1):
+        player = self.get_player(ctx)
+        queue = player.queue
+        if queue:
+            # Only the visible page is formatted, however long the queue is.
+            pages = (len(queue) - 1) // QUEUE_PAGE_SIZE + 1
+            page = min(max(page, 1), pages)
+            start = (page - 1) * QUEUE_PAGE_SIZE
+            queue_list = "\n".join(
+                f"**{start + i + 1}.** {track.title}" for i, track in enumerate(queue.page(start, QUEUE_PAGE_SIZE))
+            )
+            embed = self.create_embed("Current Queue", queue_list)
+            embed.set_footer(text=f"Page {page}/{pages} · {len(queue)} songs · loop: {player.loop_mode}")
+            await ctx.send(embed=embed)
         else:
             await ctx.send(embed=self.create_embed("Empty Queue", "The queue is currently empty."))
 
+    @commands.command(name="remove")
+    async def remove(self, ctx, number: int):
+        queue = self.get_player(ctx).queue
+        if not 1 <= number <= len(queue):
+            return await ctx.send(embed=self.create_embed("Error", f"Pick a number between 1 and {len(queue)}.", discord.Color.red()))
+        track = queue.remove(number - 1)
+        self.get_player(ctx).prefetch()
+        await ctx.send(embed=self.create_embed("Song Removed", f"Removed `{track.title}` from the queue."))
+
+    @commands.command(name="move")
+    async def move(self, ctx, source: int, destination: int):
+        queue = self.get_player(ctx).queue
+        if not (1 <= source <= len(queue) and 1 <= destination <= len(queue)):
+            return await ctx.send(embed=self.create_embed("Error", f"Pick numbers between 1 and {len(queue)}.", discord.Color.red()))
+        track = queue.move(source - 1, destination - 1)
+        self.get_player(ctx).prefetch()
+        await ctx.send(embed=self.create_embed("Song Moved", f"Moved `{track.title}` to position {destination}."))
+
+    @commands.command(name="shuffle")
+    async def shuffle(self, ctx):
+        player = self.get_player(ctx)
+        player.queue.shuffle()
+        player.prefetch()
+        await ctx.send(embed=self.create_embed("Queue Shuffled", f"Shuffled {len(player.queue)} songs."))
+
+    @commands.command(name="loop")
+    async def loop(self, ctx, mode: str = None):
+        player = self.get_player(ctx)
+        if mode is None:
+            mode = LOOP_MODES[(LOOP_MODES.index(player.loop_mode) + 1) % len(LOOP_MODES)]
+        if mode not in LOOP_MODES:
+            return await ctx.send(embed=self.create_embed("Error", f"Loop mode must be one of: {', '.join(LOOP_MODES)}.", discord.Color.red()))
+        player.loop_mode = mode
+        player.prefetch()
+        await ctx.send(embed=self.create_embed("Loop Mode", f"Loop mode set to `{mode}`."))
+
     @commands.command(name="skip")
     async def skip(self, ctx):
         if ctx.voice_client and ctx.voice_client.is_playing():
-            ctx.voice_client.stop()
+            self.get_player(ctx).skip()
             await ctx.send(embed=self.create_embed("Song Skipped", "The current song has been skipped."))
 
     @commands.command(name="stop")
     async def stop(self, ctx):
-        queue = await self.get_queue(ctx)
-        while not queue.empty():
-            await queue.get()
-        if ctx.voice_client:
-            ctx.voice_client.stop()
+        extraction_engine.cancel(ctx.guild.id)
+        self.get_player(ctx).stop()
+        self.updates.refresh_message(ctx.guild.id)
         await ctx.send(embed=self.create_embed("Playback Stopped", "Music has been stopped and the queue has been cleared."))
 
+    @commands.command(name="stats")
+    @commands.is_owner()
+    async def stats(self, ctx):
+        cache_stats = extraction_cache.stats()
+        engine_stats = extraction_engine.stats()
+        embed = self.create_embed("Extraction Stats", f"Cache hit rate: {cache_stats['hit_rate']:.1%}")
+        for name, value in cache_stats.items():
+            if name != "hit_rate":
+                embed.add_field(name=f"Cache {name.replace('_', ' ')}", value=str(value))
+        for name, value in engine_stats.items():
+            value = f"{value * 1000:.0f} ms" if name.startswith("avg_") else str(value)
+            embed.add_field(name=f"Workers {name.replace('_', ' ')}", value=value)
+        if config.AUDIO_WORKERS:
+            for name, value in audio_workers.stats().items():
+                embed.add_field(name=f"Audio {name.replace('_', ' ')}", value=str(value))
+        if audio_cache.enabled:
+            audio_stats = audio_cache.stats()
+            embed.add_field(name="Audio cache", value=f"{audio_stats['files']} files, {audio_stats['size_mb']:.0f} MB")
+            embed.add_field(name="Audio cache hit rate", value=f"{audio_stats['hit_rate']:.1%}")
+            embed.add_field(name="Audio cache downloads", value=f"{audio_stats['downloads']} ({audio_stats['evictions']} evicted)")
+        search_stats = youtube_search.stats()
+        embed.add_field(name="Search hit rate", value=f"{search_stats['hit_rate']:.1%}")
+        embed.add_field(name="Search quota used today", value=str(search_stats["quota_used"]))
+        janitor_stats = self.janitor.stats()
+        embed.add_field(
+            name="Janitor reclaimed",
+            value=", ".join(f"{value} {name.replace('_', ' ')}" for name, value in janitor_stats.items() if name != "sweeps")
+            + f" in {janitor_stats['sweeps']} sweeps",
+            inline=False,
+        )
+        recoveries = sum(player.recoveries for player in self.players.values())
+        recovery_seconds = sum(player.recovery_seconds for player in self.players.values())
+        embed.add_field(
+            name="Stream recoveries",
+            value=f"{recoveries} ({recovery_seconds / recoveries if recoveries else 0:.2f}s avg), "
+            + f"{sum(player.recovery_failures for player in self.players.values())} failed",
+        )
+        update_stats = self.updates.stats()
+        embed.add_field(name="Presence updates", value=f"{update_stats['presence_updates']} of {update_stats['presence_requests']} requested")
+        embed.add_field(name="Message edits", value=f"{update_stats['edits_sent']} of {update_stats['edit_requests']} requested")
+        if ctx.voice_client and isinstance(ctx.voice_client.source, MixingSource):
+            mixer_stats = ctx.voice_client.source.stats()
+            embed.add_field(name="Mixer avg frame", value=f"{mixer_stats['avg_frame_time'] * 1e6:.0f} µs")
+            embed.add_field(name="Mixer max frame", value=f"{mixer_stats['max_frame_time'] * 1e6:.0f} µs")
+        await ctx.send(embed=embed)
+
     @commands.Cog.listener()
     async def on_command_error(self, ctx, error):
+        if ctx.command is not None:
+            metrics.COMMAND_ERRORS.inc(ctx.command.name, type(error).__name__)
         if isinstance(error, commands.CommandNotFound):
             return
         elif isinstance(error, commands.MissingRequiredArgument):
@@ -194,4 +471,6 @@ class MusicCog(commands.Cog):
             raise error
 
 async def setup(bot):
+    if config.METRICS_PORT and not metrics.enabled:
+        await metrics.start(config.METRICS_HOST, config.METRICS_PORT)
     await bot.add_cog(MusicCog(bot))
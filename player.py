@@ -0,0 +1,362 @@
+# player.py
+
+import asyncio
+import itertools
+import logging
+import random
+import time
+from collections import deque
+
+import config
+import metrics
+from audio import MixingSource
+from tracks import Track
+
+log = logging.getLogger(__name__)
+
+LOOP_MODES = ("off", "track", "queue")
+
+
+class TrackQueue:
+    # Deque-backed queue: O(1) append/popleft at either end, and remove/insert at an
+    # index are a C-level rotation rather than a Python loop, so 10k entries stay cheap.
+    # `version` changes on every edit except popleft, which only bumps `popped`, so
+    # snapshots can record playback progress without rewriting the whole queue.
+    def __init__(self, tracks=()):
+        self._items = deque(tracks)
+        self.version = 0
+        self.popped = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __bool__(self):
+        return bool(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def append(self, track):
+        self._items.append(track)
+        self.version += 1
+
+    def appendleft(self, track):
+        self._items.appendleft(track)
+        self.version += 1
+
+    def extend(self, tracks):
+        self._items.extend(tracks)
+        self.version += 1
+
+    def popleft(self):
+        track = self._items.popleft()
+        self.popped += 1
+        return track
+
+    def remove(self, index):
+        track = self._items[index]
+        del self._items[index]
+        self.version += 1
+        return track
+
+    def move(self, source, destination):
+        track = self.remove(source)
+        self._items.insert(destination, track)
+        return track
+
+    def shuffle(self):
+        items = list(self._items)
+        random.shuffle(items)
+        self._items = deque(items)
+        self.version += 1
+
+    def clear(self):
+        items, self._items = self._items, deque()
+        self.version += 1
+        return items
+
+    def peek(self, count):
+        return list(itertools.islice(self._items, count))
+
+    def page(self, start, count):
+        return list(itertools.islice(self._items, start, start + count))
+
+
+class GuildPlayer:
+    # Playback engine for one guild: owns the queue, the loop mode and the current
+    # track, prefetches upcoming sources and chains them into the mixer for gapless
+    # handovers. The audio thread only ever hands control back through the event
+    # loop's thread-safe entry points.
+    def __init__(self, guild, *, loop, loader, on_start=None, on_idle=None, on_error=None):
+        self.guild = guild
+        self.loop = loop
+        self.loader = loader
+        self.on_start = on_start
+        self.on_idle = on_idle
+        self.on_error = on_error
+        self.queue = TrackQueue()
+        self.loop_mode = "off"
+        # None leaves each source at its own default until ?volume is used.
+        self.volume = None
+        self.current = None
+        self.armed = None
+        # The track play_next is resolving: off the queue but not yet current.
+        self.loading = None
+        self.channel = None
+        self.skipping = False
+        self.prefetched = set()
+        self.last_active = time.monotonic()
+        self.recoveries = 0
+        self.recovery_failures = 0
+        self.recovery_seconds = 0.0
+        self._lock = asyncio.Lock()
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    @property
+    def source(self):
+        voice_client = self.voice_client
+        return voice_client.source if voice_client else None
+
+    def _source(self, track):
+        return self.loader(track, volume=self.volume, offset=track.offset)
+
+    def prefetch(self):
+        # Resolves the next few entries in the background so track changes have no gap.
+        # Together with the playing track this bounds ffmpeg processes per guild.
+        # Entries that fell out of the window (moved, removed, shuffled) release theirs.
+        upcoming = self.queue.peek(config.PLAYLIST_LOOKAHEAD)
+        if self.loop_mode == "track" and self.current is not None:
+            upcoming = [self.current]
+        for track in self.prefetched.difference(upcoming):
+            track.discard()
+        for track in upcoming:
+            track.prefetch(self._source)
+        self.prefetched = set(upcoming)
+
+    def _next_track(self):
+        # A track still being armed was already taken off the front of the queue: it
+        # goes back there so it plays next, and arm_next drops its load once it sees that.
+        self._unarm()
+        finished, self.current = self.current, None
+        skipping, self.skipping = self.skipping, False
+        if finished is not None and self.loop_mode == "track" and not skipping:
+            return finished
+        if finished is not None and self.loop_mode == "queue":
+            self.queue.append(finished)
+        return self.queue.popleft() if self.queue else None
+
+    async def play_next(self, requested_at=None):
+        async with self._lock:
+            voice_client = self.voice_client
+            if voice_client is None or voice_client.is_playing() or voice_client.is_paused():
+                return
+            while True:
+                track = self._next_track()
+                if track is None:
+                    if self.on_idle:
+                        await self.on_idle(self)
+                    return
+                self.loading = track
+                try:
+                    source = await track.load(self._source)
+                    break
+                except asyncio.CancelledError:
+                    # The lookup was cancelled by ?leave: the track stays first in the
+                    # queue. ?stop clears `loading` along with the queue.
+                    if self.loading is track:
+                        self.queue.appendleft(track)
+                    raise
+                except Exception as e:
+                    if self.on_error:
+                        await self.on_error(self, track, e)
+                finally:
+                    self.loading = None
+            if self.voice_client is not voice_client or voice_client.is_playing():
+                source.cleanup()
+                self.queue.appendleft(track)
+                return
+            self.current = track
+            self.last_active = time.monotonic()
+            track.offset = 0.0
+            if self.volume is not None and source.volume != self.volume:
+                # Prefetched before the last volume change.
+                source.volume = self.volume
+            source.requested_at = requested_at
+            source.on_drop = self._dropped
+            if isinstance(source, MixingSource):
+                # Set before play(): a short or seeked track can reach its preload point at once.
+                source.on_preload = lambda mixer: asyncio.run_coroutine_threadsafe(self.arm_next(mixer), self.loop)
+                source.on_advance = lambda mixer: asyncio.run_coroutine_threadsafe(self.advanced(mixer), self.loop)
+            voice_client.play(source, after=self._after)
+            self.prefetch()
+        if self.on_start:
+            await self.on_start(self, source)
+
+    def _after(self, error):
+        # Runs on the audio thread.
+        asyncio.run_coroutine_threadsafe(self.play_next(), self.loop)
+
+    def _dropped(self, source):
+        # Runs on the audio thread.
+        asyncio.run_coroutine_threadsafe(self.recover(source), self.loop)
+
+    async def recover(self, source):
+        # Resumes a stream that ended early: the track is re-resolved without the cache
+        # (its URL has likely expired) and a new source seeks to where playback stopped.
+        # It takes over in place once buffered, so the track is never reported finished.
+        track = source.track
+        try:
+            replacement = await self.loader(track, volume=source.volume, offset=source.position, refresh=True)
+            if isinstance(replacement, MixingSource):
+                await self.loop.run_in_executor(None, replacement.prebuffer, config.RECOVERY_PREBUFFER)
+        except Exception as e:
+            log.warning("could not recover %s at %.0fs: %s", track.title, source.position, e)
+            self.recovery_failures += 1
+            metrics.STREAM_RECOVERIES.inc("failed")
+            # The next read ends the track as usual.
+            source.on_drop = None
+            source.recovering = None
+            return
+        voice_client = self.voice_client
+        if voice_client is None or voice_client.source is not source or source.track is not track:
+            # Skipped or stopped meanwhile.
+            replacement.cleanup()
+            return
+        replacement.recoveries = source.recoveries
+        replacement.on_drop = self._dropped
+        if isinstance(source, MixingSource) and isinstance(replacement, MixingSource):
+            replacement._gain = source._gain
+            replacement.preload_requested = source.preload_requested
+            replacement.on_preload = source.on_preload
+            replacement.on_advance = source.on_advance
+            replacement.next, source.next = source.next, None
+        if self.volume is not None and replacement.volume != self.volume:
+            replacement.volume = self.volume
+        voice_client.source = replacement
+        source.cleanup()
+        elapsed = time.perf_counter() - source.recovering
+        self.recoveries += 1
+        self.recovery_seconds += elapsed
+        metrics.STREAM_RECOVERIES.inc("recovered")
+        metrics.STREAM_RECOVERY_SECONDS.observe(elapsed)
+        log.info("recovered %s at %.0fs in %.2fs", track.title, replacement.position, elapsed)
+
+    async def arm_next(self, source):
+        # Hands the next track to the mixer a few seconds early so it plays without a gap.
+        if source.closed or source.next is not None or self.armed is not None:
+            return
+        if self.loop_mode == "track" and self.current is not None:
+            track = self.current
+        elif self.queue:
+            track = self.queue.popleft()
+        else:
+            return
+        self.armed = track
+        try:
+            upcoming = await track.load(self._source)
+        except Exception:
+            # play_next retries it once the current track ends and reports the error.
+            self._unarm()
+            return
+        if source.closed or self.source is not source or self.armed is not track or not isinstance(upcoming, MixingSource):
+            upcoming.cleanup()
+            if self.armed is track:
+                self._unarm()
+            return
+        source.chain(upcoming)
+        self.prefetch()
+
+    def _unarm(self):
+        armed, self.armed = self.armed, None
+        if armed is not None and armed is not self.current:
+            self.queue.appendleft(armed)
+
+    def disarm(self):
+        # Puts a chained-but-unplayed track back at the front of the queue.
+        source = self.source
+        upcoming = getattr(source, "next", None)
+        if upcoming is not None:
+            source.next = None
+            upcoming.cleanup()
+        self._unarm()
+
+    async def advanced(self, source):
+        finished, self.current, self.armed = self.current, source.track, None
+        if finished is not None and finished is not self.current and self.loop_mode == "queue":
+            self.queue.append(finished)
+        if self.volume is not None and source.volume != self.volume:
+            source.volume = self.volume
+        self.prefetch()
+        if self.on_start:
+            await self.on_start(self, source)
+
+    def set_volume(self, volume):
+        self.volume = volume
+        if self.source is not None:
+            self.source.volume = volume
+
+    def sources(self):
+        # Every live source this player owns: the playing one (with anything chained
+        # to it) and finished prefetches.
+        sources = [self.source] if self.source is not None else []
+        sources += [track.loaded for track in self.prefetched if track.loaded is not None]
+        return sources
+
+    def snapshot(self):
+        # Playback header for SnapshotStore (the queue is stored separately); None once
+        # there is nothing left to resume.
+        if self.current is None and not self.queue:
+            return None
+        voice_client = self.voice_client
+        armed = self.armed if self.armed is not self.current else None
+        return {
+            "current": self.current.pack() if self.current else None,
+            "offset": round(getattr(self.source, "position", 0.0), 2) if self.current else 0.0,
+            "armed": armed.pack() if armed else None,
+            "volume": self.volume,
+            "loop": self.loop_mode,
+            "channel": self.channel.id if self.channel else None,
+            "voice_channel": voice_client.channel.id if voice_client and voice_client.channel else None,
+        }
+
+    def restore(self, state, entries):
+        # Rebuilds the queue from a snapshot. Nothing is extracted here: entries come
+        # back flat and resolve once they reach the prefetch window, and the interrupted
+        # track seeks to where it stopped.
+        tracks = [Track.unpack(entry) for entry in entries]
+        if state.get("armed"):
+            tracks.insert(0, Track.unpack(state["armed"]))
+        if state.get("current"):
+            current = Track.unpack(state["current"])
+            current.offset = state.get("offset") or 0.0
+            tracks.insert(0, current)
+        self.queue.extend(tracks)
+        self.loop_mode = state.get("loop", self.loop_mode)
+        self.volume = state.get("volume", self.volume)
+
+    def skip(self):
+        self.disarm()
+        self.skipping = True
+        self.voice_client.stop()
+
+    def stop(self):
+        self.release()
+        self.queue.clear()
+        self.loading = None
+        if self.voice_client:
+            self.voice_client.stop()
+
+    def release(self):
+        # Drops prefetched sources without touching the queue, e.g. when leaving a channel.
+        self.disarm()
+        # The track that was playing is over, so a snapshot no longer resumes it.
+        self.current = None
+        for track in self.prefetched:
+            track.discard()
+        self.prefetched = set()
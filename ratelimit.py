@@ -0,0 +1,32 @@
+# ratelimit.py
+
+import time
+
+
+class TokenBucket:
+    # `rate` tokens per second up to `burst`; a rate of 0 never throttles.
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.burst
+
+    def delay(self, now):
+        # Seconds until a token is available; 0 when one can be taken now.
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate:
+            self.tokens -= 1
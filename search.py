@@ -0,0 +1,112 @@
+# search.py
+
+import asyncio
+import datetime
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from zoneinfo import ZoneInfo
+
+# search.list costs 100 units of the daily quota, which resets at midnight Pacific.
+SEARCH_COST = 100
+QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+
+class YouTubeSearch:
+    # Wraps the YouTube Data API search endpoint. The client is built once from the
+    # bundled (static) discovery document; requests run on a small thread pool, each
+    # thread reusing its own keep-alive HTTP connection, so the event loop never blocks.
+    # Results are cached per normalized query with a TTL and an LRU bound.
+    def __init__(self, api_key, *, ttl=3600, max_entries=1024, workers=4, timeout=10):
+        self.api_key = api_key
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.results = OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.quota_used = 0
+        self.quota_day = None
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="youtube-search")
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                from googleapiclient.discovery import build
+                self._client = build(
+                    "youtube", "v3", developerKey=self.api_key, static_discovery=True, cache_discovery=False
+                )
+            return self._client
+
+    def _http(self):
+        # httplib2 connections are not thread-safe, so each pool thread keeps its own.
+        http = getattr(self._local, "http", None)
+        if http is None:
+            import httplib2
+            http = self._local.http = httplib2.Http(timeout=self.timeout)
+        return http
+
+    def _execute(self, query, max_results):
+        request = self.client.search().list(q=query, part="snippet", maxResults=max_results, type="video")
+        return request.execute(http=self._http())
+
+    def _charge(self, units):
+        today = datetime.datetime.now(QUOTA_TIMEZONE).date()
+        if today != self.quota_day:
+            self.quota_day, self.quota_used = today, 0
+        self.quota_used += units
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.results),
+            "quota_used": self.quota_used,
+        }
+
+    def expire(self):
+        # Drops results past their TTL; returns how many were removed.
+        now = time.monotonic()
+        expired = [key for key, (_, stored) in self.results.items() if now - stored >= self.ttl]
+        for key in expired:
+            del self.results[key]
+        return len(expired)
+
+    async def search(self, query, max_results=10):
+        # Returns a list of (title, video_id) tuples.
+        key = (normalize_query(query), max_results)
+        cached = self.results.get(key)
+        if cached is not None and time.monotonic() - cached[1] < self.ttl:
+            self.results.move_to_end(key)
+            self.hits += 1
+            return cached[0]
+        if key in self.inflight:
+            # Someone else is already asking the API for this exact query.
+            self.hits += 1
+            return await asyncio.shield(self.inflight[key])
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        future = self.inflight[key] = loop.run_in_executor(self._executor, self._execute, query, max_results)
+        try:
+            response = await asyncio.shield(future)
+        finally:
+            self.inflight.pop(key, None)
+        self._charge(SEARCH_COST)
+        videos = [(item["snippet"]["title"], item["id"]["videoId"]) for item in response.get("items", [])]
+        self.results[key] = (videos, time.monotonic())
+        self.results.move_to_end(key)
+        while len(self.results) > self.max_entries:
+            self.results.popitem(last=False)
+        return videos
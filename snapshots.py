@@ -0,0 +1,142 @@
+# snapshots.py
+
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(",", ":"))
+
+
+class SnapshotStore:
+    # Persists every guild's player so a restart resumes where it left off. The
+    # playback header (current track, offset, volume, loop mode, channels) and the
+    # queue are separate rows: the header is rewritten on each flush while playing,
+    # the queue only when it was edited. Tracks that merely finished are recorded as
+    # a `consumed` count in the header. Flushes are batched on an interval and the
+    # SQLite writes run on a worker thread, so the event loop never waits on disk.
+    def __init__(self, path, *, interval=10):
+        self.interval = interval
+        self.flushes = 0
+        self.header_writes = 0
+        self.queue_writes = 0
+        self._written = {}
+        self._task = None
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS players (guild_id INTEGER PRIMARY KEY, state TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS queues (guild_id INTEGER PRIMARY KEY, entries TEXT NOT NULL)")
+
+    def load(self):
+        # Returns {guild_id: (state, entries)} for every saved guild.
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT players.guild_id, state, entries FROM players LEFT JOIN queues USING (guild_id)"
+            ).fetchall()
+        return {guild_id: self._decode(state, entries) for guild_id, state, entries in rows}
+
+    def load_guild(self, guild_id):
+        # Returns one guild's (state, entries), or None if nothing was saved.
+        with self._lock:
+            row = self._db.execute(
+                "SELECT state, entries FROM players LEFT JOIN queues USING (guild_id) WHERE guild_id = ?", (guild_id,)
+            ).fetchone()
+        return self._decode(*row) if row else None
+
+    def forget(self, guild_id):
+        # Called when a player is dropped from memory; its rows stay on disk, but the
+        # next player for the guild is a new queue and must be written out in full.
+        self._written.pop(guild_id, None)
+
+    @staticmethod
+    def _decode(state, entries):
+        state = json.loads(state)
+        entries = json.loads(entries) if entries else []
+        return state, entries[state.pop("consumed", 0):]
+
+    def start(self, players):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run(players))
+
+    async def stop(self, players):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush(players)
+
+    async def _run(self, players):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush(players)
+            except Exception:
+                log.exception("snapshot flush failed")
+
+    async def flush(self, players):
+        # Collects what changed on the loop (cheap: the queue is only copied when it
+        # was edited) and hands serialization and the write to a thread.
+        headers, queues, removed, written = [], [], [], {}
+        for guild_id, player in list(players.items()):
+            state = player.snapshot()
+            if state is None:
+                if guild_id in self._written:
+                    removed.append(guild_id)
+                continue
+            queue = player.queue
+            version, popped, header = self._written.get(guild_id, (None, 0, None))
+            edited = version != queue.version
+            if edited:
+                queues.append((guild_id, [track.pack() for track in queue]))
+                popped = queue.popped
+            state["consumed"] = queue.popped - popped
+            if header == state and not edited:
+                continue
+            headers.append((guild_id, state))
+            written[guild_id] = (queue.version, popped, state)
+        if not (headers or removed):
+            return
+        await asyncio.get_running_loop().run_in_executor(None, self._write, headers, queues, removed)
+        for guild_id in removed:
+            self._written.pop(guild_id, None)
+        self._written.update(written)
+        self.flushes += 1
+        self.header_writes += len(headers)
+        self.queue_writes += len(queues)
+
+    def _write(self, headers, queues, removed):
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO players (guild_id, state, updated) VALUES (?, ?, ?)",
+                    [(guild_id, _dumps(state), now) for guild_id, state in headers],
+                )
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO queues (guild_id, entries) VALUES (?, ?)",
+                    [(guild_id, _dumps(entries)) for guild_id, entries in queues],
+                )
+                self._db.executemany("DELETE FROM players WHERE guild_id = ?", [(guild_id,) for guild_id in removed])
+                self._db.executemany("DELETE FROM queues WHERE guild_id = ?", [(guild_id,) for guild_id in removed])
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def stats(self):
+        return {
+            "guilds": len(self._written),
+            "flushes": self.flushes,
+            "header_writes": self.header_writes,
+            "queue_writes": self.queue_writes,
+        }
@@ -0,0 +1,95 @@
+# tracks.py
+
+import asyncio
+import time
+
+import config
+from cache import stream_expiry
+
+
+class Track:
+    # A queued entry. Playlists are enumerated flat, so most tracks start out with
+    # only id/title/duration and get their stream URL when they are about to play.
+    # Only the fields playback needs are kept; the extract_info dict is not retained.
+    __slots__ = (
+        "id", "title", "duration", "thumbnail", "acodec", "asr", "webpage_url", "stream_url", "expires", "offset",
+        "_loading",
+    )
+
+    def __init__(self, data):
+        self.id = data.get("id")
+        self.title = data.get("title")
+        self.duration = int(data["duration"]) if data.get("duration") else None
+        self.thumbnail = data.get("thumbnail")
+        self.acodec = data.get("acodec")
+        self.asr = data.get("asr")
+        if data.get("_type") == "url":
+            # Flat playlist entries carry the watch page in "url", not a stream.
+            self.webpage_url = data.get("webpage_url") or data.get("url")
+            self.stream_url = None
+        else:
+            self.webpage_url = data.get("webpage_url") or data.get("original_url")
+            self.stream_url = data.get("url")
+        self.expires = stream_expiry(self.stream_url)
+        # Seconds to seek to when the source is built, e.g. resuming after a restart.
+        self.offset = 0.0
+        self._loading = None
+
+    def pack(self):
+        # Compact form for snapshots: enough to requeue the entry and re-resolve it later.
+        return [self.id, self.title, self.duration, self.webpage_url]
+
+    @classmethod
+    def unpack(cls, entry):
+        video_id, title, duration, webpage_url = entry
+        return cls({"_type": "url", "id": video_id, "title": title, "duration": duration, "url": webpage_url})
+
+    @property
+    def resolved(self):
+        if self.stream_url is None:
+            return False
+        return self.expires is None or self.expires - config.STREAM_URL_MARGIN > time.time()
+
+    def update(self, data):
+        self.id = data.get("id") or self.id
+        self.title = data.get("title") or self.title
+        self.duration = int(data["duration"]) if data.get("duration") else self.duration
+        self.thumbnail = data.get("thumbnail") or self.thumbnail
+        self.webpage_url = data.get("webpage_url") or self.webpage_url
+        self.acodec = data.get("acodec")
+        self.asr = data.get("asr")
+        self.stream_url = data.get("url")
+        self.expires = stream_expiry(self.stream_url)
+
+    def prefetch(self, loader):
+        # Starts building the audio source in the background; `loader` is a coroutine
+        # function taking the track. Calling it again while a load is pending is a no-op.
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(loader(self))
+        return self._loading
+
+    async def load(self, loader):
+        # Hands out the prefetched source (or builds one now). A source can only be
+        # played once, so the pending load is consumed here.
+        loading = self.prefetch(loader)
+        self._loading = None
+        return await loading
+
+    @property
+    def loaded(self):
+        # The prefetched source once it is ready, else None.
+        loading = self._loading
+        if loading is None or not loading.done() or loading.cancelled() or loading.exception() is not None:
+            return None
+        return loading.result()
+
+    def discard(self):
+        # Drops a prefetched source so its ffmpeg process does not linger.
+        loading, self._loading = self._loading, None
+        if loading is None:
+            return
+        if loading.done():
+            if not loading.cancelled() and loading.exception() is None:
+                loading.result().cleanup()
+        else:
+            loading.cancel()
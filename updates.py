@@ -0,0 +1,179 @@
+# updates.py
+
+import asyncio
+import logging
+import time
+
+import discord
+
+from ratelimit import TokenBucket
+
+log = logging.getLogger(__name__)
+
+
+class LiveMessage:
+    def __init__(self, message, render, embed=None):
+        self.message = message
+        self.render = render
+        self.dirty = False
+        self.edited = time.monotonic()
+        # What the message shows now, so an edit that would change nothing is skipped.
+        self.content = embed.to_dict() if embed is not None else None
+
+
+class UpdateScheduler:
+    # Coalesces outbound updates so gateway and REST traffic doesn't scale with track
+    # churn. Presence is global: guilds report what they play, and at most one
+    # change_presence goes out per `presence_interval`, naming the track when one guild
+    # is playing and a count otherwise. Now-playing messages are edited in place: a
+    # change only marks the message dirty and it is rendered when its edit goes out, so
+    # superseded states are never sent. Edits are paced by a token bucket per guild
+    # (Discord limits edits per channel) and a global one that keeps the total under the
+    # REST rate limit; a live message is refreshed at most once per `refresh` seconds.
+    def __init__(self, bot, *, presence_interval=15, refresh=15, edit_rate=1, edit_burst=5, global_edit_rate=20,
+                 tick=1):
+        self.bot = bot
+        self.presence_interval = presence_interval
+        self.refresh = refresh
+        self.tick = tick
+        self.edit_rate = edit_rate
+        self.edit_burst = edit_burst
+        self.edits = TokenBucket(global_edit_rate, global_edit_rate)
+        self.guild_edits = {}
+        self.playing = {}
+        self.live = {}
+        self.presence_requests = 0
+        self.presence_updates = 0
+        self.edit_requests = 0
+        self.edits_sent = 0
+        self.edits_unchanged = 0
+        self._sent = ()
+        self._presence_dirty = asyncio.Event()
+        self._tasks = []
+
+    def start(self):
+        if not self._tasks:
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._presence_loop()), loop.create_task(self._edit_loop())]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def stats(self):
+        return {
+            "presence_requests": self.presence_requests,
+            "presence_updates": self.presence_updates,
+            "edit_requests": self.edit_requests,
+            "edits_sent": self.edits_sent,
+            "edits_unchanged": self.edits_unchanged,
+            "live_messages": len(self.live),
+        }
+
+    def set_presence(self, guild_id, title):
+        # `title=None` means the guild stopped playing.
+        self.presence_requests += 1
+        if title is None:
+            self.playing.pop(guild_id, None)
+        else:
+            self.playing[guild_id] = title
+        self._presence_dirty.set()
+
+    def _status(self):
+        if not self.playing:
+            return ()
+        if len(self.playing) == 1:
+            return (next(iter(self.playing.values())),)
+        return (f"music in {len(self.playing)} servers",)
+
+    async def _presence_loop(self):
+        while True:
+            await self._presence_dirty.wait()
+            self._presence_dirty.clear()
+            status = self._status()
+            if status == self._sent:
+                continue
+            activity = discord.Activity(type=discord.ActivityType.listening, name=status[0]) if status else None
+            try:
+                await self.bot.change_presence(activity=activity)
+                self._sent = status
+                self.presence_updates += 1
+            except Exception:
+                log.exception("presence update failed")
+            # Anything that changes meanwhile is folded into the next update.
+            await asyncio.sleep(self.presence_interval)
+
+    def track_message(self, guild_id, message, render, embed=None):
+        # Keeps `message` in sync with `render()` (an embed, or None to stop tracking);
+        # `embed` is what it was sent with. A guild has one live message; posting a new
+        # one retires the old.
+        self.live[guild_id] = LiveMessage(message, render, embed)
+
+    def refresh_message(self, guild_id):
+        live = self.live.get(guild_id)
+        if live is not None:
+            self.edit_requests += 1
+            live.dirty = True
+
+    def forget(self, guild_id):
+        self.playing.pop(guild_id, None)
+        self.live.pop(guild_id, None)
+        self.guild_edits.pop(guild_id, None)
+
+    def _guild_bucket(self, guild_id):
+        bucket = self.guild_edits.get(guild_id)
+        if bucket is None:
+            bucket = self.guild_edits[guild_id] = TokenBucket(self.edit_rate, self.edit_burst)
+        return bucket
+
+    async def _edit_loop(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self._send_edits()
+            except Exception:
+                log.exception("message updates failed")
+
+    async def _send_edits(self):
+        now = time.monotonic()
+        due = [
+            (guild_id, live) for guild_id, live in self.live.items()
+            if live.dirty or now - live.edited >= self.refresh
+        ]
+        # Longest-waiting first; whatever the buckets can't cover waits for the next tick.
+        due.sort(key=lambda item: item[1].edited)
+        for guild_id, live in due:
+            embed = live.render()
+            if embed is None:
+                self.live.pop(guild_id, None)
+                continue
+            content = embed.to_dict()
+            now = time.monotonic()
+            if content == live.content:
+                live.dirty = False
+                live.edited = now
+                self.edits_unchanged += 1
+                continue
+            if self.edits.delay(now):
+                break
+            bucket = self._guild_bucket(guild_id)
+            if bucket.delay(now):
+                continue
+            self.edits.take()
+            bucket.take()
+            # Changes from here on mark it dirty again and go out in a later edit.
+            live.dirty = False
+            live.edited = now
+            try:
+                await live.message.edit(embed=embed)
+                live.content = content
+                self.edits_sent += 1
+            except (discord.NotFound, discord.Forbidden):
+                if self.live.get(guild_id) is live:
+                    del self.live[guild_id]
+            except discord.HTTPException as e:
+                log.warning("could not edit now playing message in %s: %s", guild_id, e)
+        for guild_id in [guild_id for guild_id, bucket in self.guild_edits.items() if bucket.full]:
+            if guild_id not in self.live:
+                del self.guild_edits[guild_id]
@@ -0,0 +1,328 @@
+# workers.py
+
+import itertools
+import logging
+import multiprocessing
+import shlex
+import struct
+import subprocess
+import threading
+import time
+from collections import deque
+
+import discord
+
+import metrics
+from audio import FRAME_DURATION, FRAME_SIZE, OPUS_SILENCE, SILENCE, observe_frame, stream_dropped
+
+log = logging.getLogger(__name__)
+
+# Messages on a worker's frame pipe: stream id and kind, then the payload.
+HEADER = struct.Struct("<IB")
+FRAME, END, FAILED = 0, 1, 2
+
+# Frames a worker may run ahead of playback; the gateway hands back credit as it reads.
+PREBUFFER_FRAMES = 25
+CREDIT_BATCH = 5
+# How long read() waits for a frame before treating the stream as finished.
+READ_TIMEOUT = 5.0
+
+
+def _scale(pcm, volume):
+    if volume == 1.0:
+        return pcm
+    import numpy as np
+    samples = np.frombuffer(pcm, dtype=np.int16) * volume
+    return np.clip(samples, -32768, 32767).astype(np.int16).tobytes()
+
+
+class _WorkerStream(threading.Thread):
+    # Worker side of one stream: ffmpeg decodes to PCM, then volume and Opus
+    # encoding happen here instead of in the gateway's AudioPlayer thread.
+    def __init__(self, stream_id, spec, send):
+        super().__init__(name=f"audio-stream-{stream_id}", daemon=True)
+        self.stream_id = stream_id
+        self.spec = spec
+        self.send = send
+        self.volume = spec["volume"]
+        self.credits = threading.Semaphore(PREBUFFER_FRAMES)
+        self.stopped = threading.Event()
+        self.process = None
+
+    def credit(self, count):
+        self.credits.release(count)
+
+    def stop(self):
+        self.stopped.set()
+        self.credits.release()
+
+    def run(self):
+        args = [
+            "ffmpeg", *shlex.split(self.spec["before_options"]), "-i", self.spec["url"],
+            "-f", "s16le", "-ar", "48000", "-ac", "2", "-loglevel", "warning",
+            *shlex.split(self.spec["options"]), "pipe:1",
+        ]
+        encoder = discord.opus.Encoder() if self.spec["encode"] else None
+        try:
+            self.process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            while True:
+                # Waiting for credit before reading lets the ffmpeg pipe apply backpressure.
+                self.credits.acquire()
+                if self.stopped.is_set():
+                    return
+                pcm = self.process.stdout.read(FRAME_SIZE)
+                if len(pcm) < FRAME_SIZE:
+                    break
+                pcm = _scale(pcm, self.volume)
+                self.send(self.stream_id, FRAME, encoder.encode(pcm, encoder.SAMPLES_PER_FRAME) if encoder else pcm)
+            self.send(self.stream_id, END)
+        except Exception as e:
+            log.exception("audio stream %s failed", self.stream_id)
+            self.send(self.stream_id, FAILED, str(e).encode())
+        finally:
+            if self.process is not None:
+                self.process.kill()
+                self.process.wait()
+
+
+def _worker_main(commands, frames):
+    try:
+        discord.opus._load_default()
+    except Exception:
+        pass
+    send_lock = threading.Lock()
+    streams = {}
+
+    def send(stream_id, kind, payload=b""):
+        with send_lock:
+            try:
+                frames.send_bytes(HEADER.pack(stream_id, kind) + payload)
+            except OSError:
+                pass
+
+    while True:
+        try:
+            action, stream_id, value = commands.recv()
+        except (EOFError, OSError):
+            break
+        if action == "start":
+            stream = streams[stream_id] = _WorkerStream(stream_id, value, send)
+            stream.start()
+        elif action == "shutdown":
+            break
+        elif stream_id in streams:
+            if action == "credit":
+                streams[stream_id].credit(value)
+            elif action == "volume":
+                streams[stream_id].volume = value
+            elif action == "stop":
+                streams.pop(stream_id).stop()
+    for stream in streams.values():
+        stream.stop()
+    for stream in streams.values():
+        stream.join(timeout=1)
+
+
+class AudioWorker:
+    # Gateway-side handle for one worker process. A reader thread routes incoming
+    # frames to the WorkerSource they belong to.
+    def __init__(self, index, context):
+        self.index = index
+        commands, self.commands = context.Pipe(duplex=False)
+        self.frames, frames = context.Pipe(duplex=False)
+        self.process = context.Process(target=_worker_main, args=(commands, frames), name=f"audio-worker-{index}", daemon=True)
+        self.process.start()
+        commands.close()
+        frames.close()
+        self.streams = {}
+        self.guilds = {}
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read, name=f"audio-worker-{index}-reader", daemon=True)
+        self._reader.start()
+
+    @property
+    def alive(self):
+        return self.process.is_alive()
+
+    def send(self, action, stream_id=0, value=None):
+        with self._lock:
+            try:
+                self.commands.send((action, stream_id, value))
+            except OSError:
+                pass
+
+    def _read(self):
+        while True:
+            try:
+                message = self.frames.recv_bytes()
+            except (EOFError, OSError):
+                break
+            stream_id, kind = HEADER.unpack_from(message)
+            source = self.streams.get(stream_id)
+            if source is not None:
+                source.deliver(kind, message[HEADER.size:])
+        for source in list(self.streams.values()):
+            source.deliver(FAILED, b"audio worker exited")
+
+    def attach(self, source):
+        self.streams[source.stream_id] = source
+        self.guilds[source.guild_id] = self.guilds.get(source.guild_id, 0) + 1
+
+    def detach(self, source):
+        if self.streams.pop(source.stream_id, None) is None:
+            return
+        self.guilds[source.guild_id] -= 1
+        if not self.guilds[source.guild_id]:
+            del self.guilds[source.guild_id]
+        self.send("stop", source.stream_id)
+
+    def shutdown(self):
+        self.send("shutdown")
+        self.commands.close()
+        self.process.join(timeout=2)
+        if self.process.is_alive():
+            self.process.kill()
+
+
+class WorkerSource(discord.AudioSource):
+    # Plays frames produced by an audio worker. read() only pops a ready frame off a
+    # deque, so the gateway's AudioPlayer threads do almost nothing under the GIL.
+    def __init__(self, track, *, worker, stream_id, guild_id, encoded, volume=0.5, offset=0.0):
+        self.track = track
+        self.title = track.title
+        self.url = track.webpage_url
+        self.duration = track.duration
+        self.thumbnail = track.thumbnail
+        self.worker = worker
+        self.stream_id = stream_id
+        self.guild_id = guild_id
+        self.encoded = encoded
+        self.offset = offset
+        self.frames = 0
+        self.requested_at = None
+        self.last_read = None
+        self.ended = False
+        self.error = None
+        self.on_drop = None
+        self.recovering = None
+        self.recoveries = 0
+        self._volume = volume
+        self._buffer = deque()
+        self._ready = threading.Condition()
+
+    @property
+    def position(self):
+        return self.offset + self.frames * FRAME_DURATION
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self._volume = max(value, 0.0)
+        self.worker.send("volume", self.stream_id, self._volume)
+
+    def deliver(self, kind, payload):
+        with self._ready:
+            if kind == FRAME:
+                self._buffer.append(payload)
+            else:
+                self.ended = True
+                if kind == FAILED:
+                    self.error = payload.decode(errors="replace")
+            self._ready.notify()
+
+    def read(self):
+        with self._ready:
+            if not self._buffer and not self.ended and self.recovering is None:
+                self._ready.wait_for(lambda: self._buffer or self.ended, timeout=READ_TIMEOUT)
+            if not self._buffer:
+                if stream_dropped(self):
+                    return OPUS_SILENCE if self.encoded else SILENCE
+                return b""
+            data = self._buffer.popleft()
+        self.frames += 1
+        if self.frames % CREDIT_BATCH == 0:
+            self.worker.send("credit", self.stream_id, CREDIT_BATCH)
+        if metrics.enabled:
+            observe_frame(self)
+        return data
+
+    def is_opus(self):
+        return self.encoded
+
+    def cleanup(self):
+        self.worker.detach(self)
+
+
+class AudioWorkerPool:
+    # Moves decoding, volume and Opus encoding into worker processes so concurrent
+    # streams scale with cores instead of sharing the gateway's GIL. A guild stays on
+    # one worker while it has live streams; new guilds go to the least loaded worker.
+    def __init__(self, workers):
+        self.size = workers
+        self.workers = []
+        self.encoded = False
+        self._ids = itertools.count(1)
+
+    def start(self):
+        if self.workers:
+            return
+        try:
+            discord.opus._load_default()
+        except Exception:
+            pass
+        # Without libopus workers ship PCM and discord.py would have to encode it anyway.
+        self.encoded = discord.opus.is_loaded()
+        started = time.perf_counter()
+        # Like the extraction pool, workers are forked before any voice threads exist.
+        context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+        self.workers = [AudioWorker(index, context) for index in range(self.size)]
+        metrics.AUDIO_WORKER_STREAMS.set_function(lambda: {(str(w.index),): len(w.streams) for w in self.workers})
+        log.info("started %s audio workers in %.2fs (opus encoding: %s)", self.size, time.perf_counter() - started, self.encoded)
+
+    def shutdown(self):
+        workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.shutdown()
+
+    def assign(self, guild_id):
+        for index, worker in enumerate(self.workers):
+            if not worker.alive:
+                log.warning("audio worker %s exited, restarting it", worker.index)
+                worker.shutdown()
+                # Voice and reader threads are running by now, so forking could copy a
+                # held lock into the child; replacements start from a fresh interpreter.
+                worker = self.workers[index] = AudioWorker(worker.index, multiprocessing.get_context("spawn"))
+            if guild_id in worker.guilds:
+                return worker
+        return min(self.workers, key=lambda worker: len(worker.streams))
+
+    def open(self, track, *, guild_id=None, volume=0.5, offset=0.0, before_options="", options=""):
+        if offset:
+            before_options = f"{before_options} -ss {offset:.2f}"
+        if not self.workers:
+            self.start()
+        worker = self.assign(guild_id)
+        source = WorkerSource(
+            track, worker=worker, stream_id=next(self._ids), guild_id=guild_id,
+            encoded=self.encoded, volume=volume, offset=offset,
+        )
+        worker.attach(source)
+        worker.send("start", source.stream_id, {
+            "url": track.stream_url,
+            "before_options": before_options,
+            "options": options,
+            "volume": volume,
+            "encode": self.encoded,
+        })
+        return source
+
+    def stats(self):
+        return {
+            "workers": len(self.workers),
+            "streams": sum(len(worker.streams) for worker in self.workers),
+            "guilds": sum(len(worker.guilds) for worker in self.workers),
+            "max_streams_per_worker": max((len(worker.streams) for worker in self.workers), default=0),
+        }